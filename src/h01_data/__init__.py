@@ -2,6 +2,7 @@ import sys
 from os import path
 
 from h01_data.vocab import Vocab
+from h01_data.embeddings import Embeddings
 from utils import utils
 from utils import constants
 
@@ -18,24 +19,42 @@ def load_vocabs(fpath):
     return (words, tags, rels)
 
 
+def load_merged_vocabs(fpaths):
+    # Merges the vocabs of several treebanks. Returns the merged (words, tags, rels),
+    # and for each treebank the arrays mapping its ids to the merged ones
+    # Words, tags and rels vocabs, each with one vocab per treebank
+    fields = zip(*[load_vocabs(fpath) for fpath in fpaths])
+    merged, remaps = zip(*[Vocab.merge(vocabs) for vocabs in fields])
+    return merged, list(zip(*remaps))
+
+
 def save_embeddings(fpath, embeddings):
-    fname = '%s/embeddings.pckl' % (fpath)
-    utils.write_data(fname, embeddings)
+    embeddings.save(fpath)
 
 
 def load_embeddings(fpath):
-    fname = '%s/embeddings.pckl' % (fpath)
-    return utils.read_data(fname)
+    return Embeddings.load(fpath)
+
+
+def load_shared_embeddings(fpaths):
+    # Treebanks processed with the same GloVe file link to the same cached store,
+    # which is mapped once for all of them
+    stores = sorted(set(path.realpath(path.join(fpath, Embeddings.VECTORS_FNAME))
+                        for fpath in fpaths))
+    if len(stores) > 1:
+        raise ValueError('Treebanks use different embedding stores: %s' % ', '.join(stores))
+    return load_embeddings(fpaths[0])
 
 
 def get_ud_fname(fpath):
-    fname_train = '%s/%s.json' % (fpath, 'train')
-    fname_dev = '%s/%s.json' % (fpath, 'dev')
-    fname_test = '%s/%s.json' % (fpath, 'test')
+    # Base names of the processed splits, see h01_data.treebank for their columns
+    fname_train = '%s/%s' % (fpath, 'train')
+    fname_dev = '%s/%s' % (fpath, 'dev')
+    fname_test = '%s/%s' % (fpath, 'test')
     return (fname_train, fname_dev, fname_test)
 
 def get_oracle_actions(fpath,transition):
-    fname_train = '%s/%s_actions_%s.json' % (fpath, transition,'train')
-    fname_dev = '%s/%s_actions_%s.json' % (fpath, transition,'dev')
-    fname_test = '%s/%s_actions_%s.json' % (fpath, transition,'test')
+    fname_train = '%s/%s_actions_%s' % (fpath, transition,'train')
+    fname_dev = '%s/%s_actions_%s' % (fpath, transition,'dev')
+    fname_test = '%s/%s_actions_%s' % (fpath, transition,'test')
     return (fname_train, fname_dev, fname_test)
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from utils import utils
+
+# Bump when the format of any preprocessed artifact changes
+CACHE_VERSION = 4
+
+
+class ArtifactCache:
+    # Content-addressed store for preprocessed artifacts. Each entry is a
+    # folder named after the hash of everything used to build it, and the
+    # manifest keeps its size and last use for LRU eviction.
+    MANIFEST = 'manifest.json'
+    LOCK = 'manifest.lock'
+    # Scratch folders, named after the process writing them
+    TMP_PREFIXES = ['build-', 'entry-']
+
+    def __init__(self, cache_path, max_size=None):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.used = set()
+        utils.mkdir(cache_path)
+        self.sweep()
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def get_tmp_prefix(prefix):
+        return '%s%d-' % (prefix, os.getpid())
+
+    def sweep(self):
+        # Removes the scratch folders left by builds that crashed, whose process is gone
+        with self.manifest():
+            for fname in os.listdir(self.cache_path):
+                prefixes = [prefix for prefix in self.TMP_PREFIXES if fname.startswith(prefix)]
+                if not prefixes or not os.path.isdir(self.get_path(fname)):
+                    continue
+                prefix = prefixes[0]
+                pid = fname[len(prefix):].split('-')[0]
+                if pid.isdigit() and self.is_running(int(pid)):
+                    continue
+                print('Removing stale cache folder: %s' % fname)
+                shutil.rmtree(self.get_path(fname), ignore_errors=True)
+
+    @staticmethod
+    def get_key(*parts):
+        data = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get_path(self, key, fname=''):
+        return os.path.join(self.cache_path, key, fname)
+
+    @contextmanager
+    def manifest(self):
+        # Several processes may share the same cache, so all manifest
+        # updates happen while holding an exclusive lock
+        with open(os.path.join(self.cache_path, self.LOCK), 'w', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fname = os.path.join(self.cache_path, self.MANIFEST)
+            try:
+                with open(fname, 'r', encoding='utf-8') as file:
+                    manifest = json.load(file)
+            except FileNotFoundError:
+                manifest = {'entries': {}, 'files': {}}
+
+            yield manifest
+
+            with open(fname + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(manifest, file, indent=1, sort_keys=True)
+            os.replace(fname + '.tmp', fname)
+
+    def file_digest(self, fname):
+        # Hashing large files is slow, so digests are reused while size and mtime match
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        with self.manifest() as manifest:
+            info = manifest['files'].get(fname, {})
+            if info.get('size') == stat.st_size and info.get('mtime') == stat.st_mtime_ns:
+                return info['digest']
+
+        digest = hashlib.sha1()
+        with open(fname, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+
+        with self.manifest() as manifest:
+            manifest['files'][fname] = {
+                'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def contains(self, key, out_path=None):
+        # Entries are checked and linked into out_path under the same lock, so
+        # another process can not evict them in between
+        with self.manifest() as manifest:
+            entry = manifest['entries'].get(key)
+            if entry is None or not all(os.path.exists(self.get_path(key, fname))
+                                        for fname in entry['files']):
+                manifest['entries'].pop(key, None)
+                return False
+            entry['last_used'] = time.time()
+            if out_path is not None:
+                self.link(key, entry, out_path)
+
+        self.used.add(key)
+        return True
+
+    @contextmanager
+    def build(self):
+        # Artifacts are written to a scratch folder and only added once complete
+        build_path = tempfile.mkdtemp(prefix=self.get_tmp_prefix('build-'), dir=self.cache_path)
+        try:
+            yield build_path
+        finally:
+            shutil.rmtree(build_path, ignore_errors=True)
+
+    def add(self, key, fnames, out_path=None):
+        entry_tmp = tempfile.mkdtemp(prefix=self.get_tmp_prefix('entry-'), dir=self.cache_path)
+        for fname in fnames:
+            os.replace(fname, os.path.join(entry_tmp, os.path.basename(fname)))
+
+        with self.manifest() as manifest:
+            if key in manifest['entries'] and os.path.isdir(self.get_path(key)):
+                # Another process built the same artifacts first
+                shutil.rmtree(entry_tmp)
+            else:
+                shutil.rmtree(self.get_path(key), ignore_errors=True)
+                os.rename(entry_tmp, self.get_path(key))
+                manifest['entries'][key] = {
+                    'files': [os.path.basename(fname) for fname in fnames],
+                    'size': sum(os.path.getsize(self.get_path(key, os.path.basename(fname)))
+                                for fname in fnames),
+                    'last_used': time.time(),
+                }
+            if out_path is not None:
+                self.link(key, manifest['entries'][key], out_path)
+        self.used.add(key)
+
+    def link(self, key, entry, out_path):
+        # Called with the manifest locked. Links are recorded in the entry, so
+        # evicting it removes them.
+        fnames = entry['files']
+        entry['links'] = sorted(set(entry.get('links', [])) | set(
+            os.path.abspath(os.path.join(out_path, fname)) for fname in fnames))
+        for fname in fnames:
+            link_name = os.path.join(out_path, fname)
+            utils.remove_if_exists(link_name)
+            os.symlink(os.path.relpath(self.get_path(key, fname), out_path), link_name)
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits its budget,
+        # never removing artifacts used by the current run
+        if self.max_size is None:
+            return
+
+        with self.manifest() as manifest:
+            entries = manifest['entries']
+            total_size = sum(entry['size'] for entry in entries.values())
+            for key in sorted(entries, key=lambda x: entries[x]['last_used']):
+                if total_size <= self.max_size:
+                    break
+                if key in self.used:
+                    continue
+
+                print('Evicting cached artifacts: %s' % ', '.join(entries[key]['files']))
+                self.unlink(key, entries[key])
+                shutil.rmtree(self.get_path(key), ignore_errors=True)
+                total_size -= entries.pop(key)['size']
+
+    def unlink(self, key, entry):
+        # Removes the links to an evicted entry, unless later processing replaced them
+        folders = set()
+        for link_name in entry.get('links', []):
+            target = os.path.realpath(self.get_path(key, os.path.basename(link_name)))
+            if os.path.islink(link_name) and os.path.realpath(link_name) == target:
+                os.remove(link_name)
+                folders.add(os.path.dirname(link_name))
+        for folder in sorted(folders):
+            print('Removed links to evicted artifacts from %s, reprocess it before training' %
+                  folder)
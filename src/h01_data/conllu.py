@@ -0,0 +1,59 @@
+import os
+import mmap
+
+# CoNLL-U columns used by the pipeline
+ID, FORM, UPOS, XPOS, HEAD, DEPREL = 0, 1, 3, 4, 6, 7
+
+
+def iter_lines(fname):
+    with open(fname, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Let the kernel drop pages behind us, so memory stays flat
+            if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            yield from iter(data.readline, b'')
+
+
+def parse_token(line):
+    fields = line.split(b'\t', DEPREL + 1)
+    return (fields[FORM].decode('utf-8'), fields[UPOS].decode('utf-8'),
+            fields[XPOS].decode('utf-8'), int(fields[HEAD]), fields[DEPREL].decode('utf-8'))
+
+
+def get_sentences(fname):
+    # Yields sentences as lists of (form, upos, xpos, head, deprel) tuples
+    sentence = []
+    for line in iter_lines(fname):
+        if line[:1] == b'#':
+            continue
+        if not line.strip():
+            if sentence:
+                yield sentence
+            sentence = []
+            continue
+
+        # Skip multiword tokens (1-2) and empty nodes (1.1) before splitting the line
+        if not line[:line.find(b'\t')].isdigit():
+            continue
+        sentence += [parse_token(line)]
+
+    if sentence:
+        yield sentence
+
+
+def count_sentences(fname):
+    # Counts sentences like get_sentences splits them, without parsing any token
+    count, in_sentence = 0, False
+    for line in iter_lines(fname):
+        if line[:1] == b'#':
+            continue
+        if not line.strip():
+            count += in_sentence
+            in_sentence = False
+        elif line[:line.find(b'\t')].isdigit():
+            in_sentence = True
+
+    # The last sentence may not be followed by a blank line
+    return count + in_sentence
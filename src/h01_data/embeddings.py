@@ -0,0 +1,205 @@
+import os
+import gzip
+import itertools
+import multiprocessing
+import numpy as np
+
+from h01_data.cache import ArtifactCache
+from utils import utils
+
+CHUNK_BYTES = 1 << 24
+INITIAL_ROWS = 1 << 16
+
+
+class Embeddings:
+    # pylint: disable=too-many-instance-attributes
+    # Pretrained vectors stored as one contiguous float32 matrix, plus a
+    # word to row index. Stores saved to disk are memory-mapped read-only,
+    # so concurrent training runs share the same pages.
+    VECTORS_FNAME = 'embeddings.npy'
+    WORDS_FNAME = 'embeddings.words'
+    ALIGNED_FNAME = 'aligned.npy'
+    ALIGNED_OOV_FNAME = 'aligned.oov.npy'
+
+    def __init__(self, words, vectors, path=None):
+        self._words = words
+        self._word2idx = None
+        self.vectors = vectors
+        self.path = path
+
+    @classmethod
+    def load(cls, fpath):
+        vectors = np.load(os.path.join(fpath, cls.VECTORS_FNAME), mmap_mode='r')
+        return cls(None, vectors, path=fpath)
+
+    def save(self, fpath):
+        np.save(os.path.join(fpath, self.VECTORS_FNAME), self.vectors)
+        with open(os.path.join(fpath, self.WORDS_FNAME), 'w', encoding='utf-8') as file:
+            file.writelines('%s\n' % word for word in self.words)
+
+    @property
+    def words(self):
+        # Words are only read when needed, a cached aligned matrix does not use them
+        if self._words is None:
+            fname = os.path.join(self.path, self.WORDS_FNAME)
+            with open(fname, 'r', encoding='utf-8', newline='') as file:
+                self._words = file.read().split('\n')[:-1]
+        return self._words
+
+    @property
+    def word2idx(self):
+        if self._word2idx is None:
+            self._word2idx = {word: i for i, word in enumerate(self.words)}
+        return self._word2idx
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def keys(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def __contains__(self, word):
+        return word in self.word2idx
+
+    def __getitem__(self, word):
+        return self.vectors[self.word2idx[word]]
+
+    def get_rows(self, words):
+        # Row of each word, falling back to its lowercase form, or -1 if missing
+        word2idx = self.word2idx
+        return np.fromiter(
+            (word2idx.get(word, word2idx.get(word.lower(), -1)) for word in words),
+            dtype=np.int64, count=len(words))
+
+    def align(self, words):
+        # Matrix with one row per word, zeros for the words without a pretrained vector
+        rows = self.get_rows(words)
+        found = rows >= 0
+        vectors = np.zeros([len(words), self.dim], dtype=np.float32)
+        vectors[found] = self.vectors[rows[found]]
+        return vectors, np.flatnonzero(~found)
+
+    def get_cache(self):
+        # Saved stores are cache entries, linked into the language folders
+        store_path = os.path.dirname(os.path.realpath(os.path.join(self.path, self.VECTORS_FNAME)))
+        return ArtifactCache(os.path.dirname(store_path)), os.path.basename(store_path)
+
+    def get_aligned(self, vocab):
+        # Returns the matrix aligned with vocab ids and the ids without a
+        # pretrained vector. Saved stores add it to their cache per vocabulary,
+        # so later runs only memory-map it and eviction covers it.
+        words = [word for word, _ in sorted(vocab.items(), key=lambda x: x[1])]
+        if self.path is None:
+            return self.align(words)
+
+        cache, store_key = self.get_cache()
+        key = cache.get_key('aligned', store_key, words)
+        if not cache.contains(key):
+            with cache.build() as build_path:
+                vectors, oov = self.align(words)
+                np.save(os.path.join(build_path, self.ALIGNED_FNAME), vectors)
+                np.save(os.path.join(build_path, self.ALIGNED_OOV_FNAME), oov)
+                cache.add(key, utils.get_filenames(build_path))
+
+        return np.load(cache.get_path(key, self.ALIGNED_FNAME), mmap_mode='r'), \
+            np.load(cache.get_path(key, self.ALIGNED_OOV_FNAME))
+
+    def __getstate__(self):
+        return {'words': self._words, 'vectors': self.vectors, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['words'], state['vectors'], path=state.get('path'))
+
+
+def open_embeddings(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def count_lines(fname):
+    if fname.endswith('.gz'):
+        return INITIAL_ROWS
+    with open(fname, 'rb') as file:
+        return sum(block.count(b'\n') for block in iter(lambda: file.read(CHUNK_BYTES), b'')) + 1
+
+
+def get_chunks(file):
+    lines = file.readlines(CHUNK_BYTES)
+    while lines:
+        yield lines
+        lines = file.readlines(CHUNK_BYTES)
+
+
+def parse_chunk(args):
+    lines, embedd_dim = args
+    words, vectors = [], np.empty([len(lines), embedd_dim], dtype=np.float32)
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        if embedd_dim == len(tokens):
+            # Skip empty word
+            continue
+        assert embedd_dim + 1 == len(tokens), 'Dimension of embeddings should be consistent'
+
+        vectors[len(words)] = np.array(tokens[1:], dtype=np.float32)
+        words += [tokens[0].decode('utf-8')]
+    return words, vectors[:len(words)]
+
+
+def get_embedd_dim(lines):
+    for line in lines:
+        tokens = line.split()
+        if tokens:
+            return len(tokens) - 1
+    return -1
+
+
+def fill_vectors(results, vectors):
+    words = []
+    for chunk_words, chunk_vectors in results:
+        start, end = len(words), len(words) + len(chunk_words)
+        if end > vectors.shape[0]:
+            vectors.resize([max(end, 2 * vectors.shape[0]), vectors.shape[1]], refcheck=False)
+        vectors[start:end] = chunk_vectors
+        words += chunk_words
+
+    vectors.resize([len(words), vectors.shape[1]], refcheck=False)
+    return words, vectors
+
+
+def drop_duplicates(words, vectors):
+    # Repeated words keep their first position and their last vector
+    word2idx = {word: i for i, word in enumerate(words)}
+    if len(word2idx) == len(words):
+        return words, vectors
+    words = list(dict.fromkeys(words))
+    return words, vectors[[word2idx[word] for word in words]]
+
+
+def read_embeddings(fname, workers=1):
+    # loading GloVe
+    n_rows = count_lines(fname)
+    with open_embeddings(fname) as file:
+        chunks = get_chunks(file)
+        first_chunk = next(chunks, [])
+        embedd_dim = get_embedd_dim(first_chunk)
+        if embedd_dim < 0:
+            return Embeddings([], np.empty([0, 0], dtype=np.float32))
+
+        vectors = np.empty([n_rows, embedd_dim], dtype=np.float32)
+        tasks = ((lines, embedd_dim) for lines in itertools.chain([first_chunk], chunks))
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                words, vectors = fill_vectors(
+                    utils.ordered_imap(pool, parse_chunk, tasks, max_pending=workers * 2),
+                    vectors)
+        else:
+            words, vectors = fill_vectors(map(parse_chunk, tasks), vectors)
+
+    return Embeddings(*drop_duplicates(words, vectors))
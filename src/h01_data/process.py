@@ -1,16 +1,33 @@
 import sys
 from os import path
 import argparse
+import multiprocessing
+from contextlib import ExitStack
+from functools import partial
 from collections import OrderedDict
 import numpy as np
 
 sys.path.append('./src/')
-from h01_data import Vocab, save_vocabs, save_embeddings
+from h01_data import Vocab, save_vocabs, save_embeddings, load_vocabs, load_embeddings
+from h01_data.cache import ArtifactCache
+from h01_data.conllu import get_sentences
+from h01_data.embeddings import read_embeddings
 from h01_data.oracle import arc_standard_oracle, arc_eager_oracle
-from h01_data.oracle import is_projective, is_good
+from h01_data.tree_properties import is_projective_batch
+from h01_data.treebank import SPLIT_COLUMNS, ACTION_COLUMNS, ColumnWriter, concat_rows
 from utils import utils
 from utils import constants
 
+CHUNK_SIZE = 500
+ORACLES = OrderedDict([
+    ('arc-standard', arc_standard_oracle),
+    ('arc-eager', arc_eager_oracle),
+])
+TRANSITION_SYSTEMS = {
+    'arc-standard': constants.arc_standard,
+    'arc-eager': constants.arc_eager,
+}
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -18,55 +35,27 @@ def get_args():
     parser.add_argument('--data-path', type=str, default='data/')
     parser.add_argument('--glove-file', type=str, required=True)
     parser.add_argument('--min-vocab-count', type=int, default=2)
-    parser.add_argument('--transition', type=str, choices=['arc-standard','arc-eager'],default='arc-eager')
+    parser.add_argument('--transition', type=str, nargs='*', choices=list(ORACLES.keys()),
+                        default=['arc-eager'])
+    parser.add_argument('--workers', type=int, default=1)
+    # Disk budget for cached artifacts, in GB
+    parser.add_argument('--cache-size', type=float, default=None)
     return parser.parse_args()
 
 
-def get_sentence(file):
-    sentence = []
-    for line in file:
-        tokens = line.strip().split()
-        if tokens and tokens[0].isdigit():
-            sentence += [tokens]
-        elif tokens:
-            pass
-        else:
-            yield sentence
-            sentence = []
-
-
 def process_sentence(sentence, vocabs):
+    # Returns the id columns of a sentence, with the root as its first token
     words, tags, rels = vocabs
-    processed = [{
-        'word': words.ROOT,
-        'word_id': words.ROOT_IDX,
-        'tag1': tags.ROOT,
-        'tag1_id': tags.ROOT_IDX,
-        'tag2': tags.ROOT,
-        'tag2_id': tags.ROOT_IDX,
-        'head': 0,
-        'rel': rels.ROOT,
-        'rel_id': rels.ROOT_IDX,
-    }]
-    heads = []
-    relations = []
-    rel2id = {}
-    for token in sentence:
-        processed += [{
-            'word': token[1],
-            'word_id': words.idx(token[1]),
-            'tag1': token[3],
-            'tag1_id': tags.idx(token[3]),
-            'tag2': token[4],
-            'tag2_id': tags.idx(token[4]),
-            'head': int(token[6]),
-            # 'head_id': token[6],
-            'rel': token[7],
-            'rel_id': rels.idx(token[7]),
-        }]
-        heads.append(int(token[6]))
-        relations.append(token[7])
-        rel2id[token[7]] = rels.idx(token[7])
+    forms, tags1, tags2, heads, relations = (list(column) for column in zip(*sentence))
+    rel_ids = rels.encode(relations)
+    processed = {
+        'words': np.concatenate([[words.ROOT_IDX], words.encode(forms)]),
+        'tags1': np.concatenate([[tags.ROOT_IDX], tags.encode(tags1)]),
+        'tags2': np.concatenate([[tags.ROOT_IDX], tags.encode(tags2)]),
+        'heads': np.array([0] + heads, dtype=np.int32),
+        'rels': np.concatenate([[rels.ROOT_IDX], rel_ids]),
+    }
+    rel2id = dict(zip(relations, rel_ids.tolist()))
 
     return processed, heads, relations, rel2id
 
@@ -84,52 +73,97 @@ def labeled_action_pairs(actions,relations):
 
     return labeled_acts
 
-def process_data(in_fname_base, out_path, mode, vocabs, oracle=None, transition_name=None):
-    in_fname = in_fname_base % mode
-    out_fname = '%s/%s.json' % (out_path, mode)
-    if oracle is not None:
-        out_fname_history = '%s/%s_actions_%s.json' % (out_path, transition_name, mode)
-        utils.remove_if_exists(out_fname_history)
+def get_actions(heads, relations, rel2id, oracle):
+    heads_proper = [0] + heads
+    sentence_proper = list(range(len(heads_proper)))
+    word2head = {w: h for (w, h) in zip(sentence_proper, heads_proper)}
 
-    utils.remove_if_exists(out_fname)
-    print('Processing: %s' % in_fname)
+    actions,relations_order = oracle(sentence_proper, word2head,relations)
+    relation_ids = [rel2id[rel] for rel in relations_order]
+    return {'transition': actions, 'relations':relation_ids,}
+
+
+WORKER_STATE = {}
+
+
+def init_worker(vocabs):
+    WORKER_STATE['vocabs'] = vocabs
+
+
+def get_transition_ids(transition):
+    actions, ids = TRANSITION_SYSTEMS[transition]
+    transition_ids = {None: -2}
+    transition_ids.update(zip(actions, ids))
+    return transition_ids
+
+
+def process_chunk(sentences, transitions):
+    # Returns the id columns for a chunk, so workers do all the encoding.
+    # Each transition system gets its own action columns, without any oracle
+    # work if only graph-based parsers will be trained.
+    vocabs = WORKER_STATE['vocabs']
+    oracles = [ORACLES[transition] for transition in transitions]
+    transition_ids = [get_transition_ids(transition) for transition in transitions]
+    processed = [process_sentence(sentence, vocabs) for sentence in sentences]
+    projective = is_projective_batch([[0] + heads for _, heads, _, _ in processed])
 
-    with open(in_fname, 'r') as file:
-        for sentence in get_sentence(file):
-            sent_processed, heads, relations,rel2id = process_sentence(sentence, vocabs)
-            heads_proper = [0] + heads
+    sentence_rows, action_rows = [], [[] for _ in transitions]
+    for (sent_processed, heads, relations, rel2id), is_projective in zip(processed, projective):
+        if not is_projective:
+            continue
+        sentence_rows += [sent_processed]
+        for oracle, ids, rows in zip(oracles, transition_ids, action_rows):
+            actions = get_actions(heads, relations, rel2id, oracle)
+            rows += [{
+                'transitions': np.array([ids[action] for action in actions['transition']],
+                                        dtype=np.int8),
+                'relations': np.array(actions['relations'], dtype=np.int32),
+            }]
 
-            # print(heads_proper)
-            # print(relations)
-            arc2label = {arc: rel for (arc, rel) in zip(list(range(len(heads))), relations)}
-            #relations = ['root'] + relations
-            # print(len(heads_proper))
-            # print(len(relations))
-            sentence_proper = list(range(len(heads_proper)))
-            #word2headrels = {w: (h, r) for (w, h, r) in zip(sentence_proper, heads_proper, relations)}
-            # print(word2headrels)
-            word2head = {w: h for (w, h) in zip(sentence_proper, heads_proper)}
-            if is_projective(word2head):
-                actions,relations_order = oracle(sentence_proper, word2head,relations)
-                relation_ids = [rel2id[rel] for rel in relations_order]
+    return concat_rows(sentence_rows, SPLIT_COLUMNS), \
+        [concat_rows(rows, ACTION_COLUMNS) for rows in action_rows]
 
-                #labeled_actions = labeled_action_pairs(actions,relation_ids.copy())
-                #actions_processed = {'transition': actions, 'relations':relation_ids,'labeled_actions':labeled_actions}
-                actions_processed = {'transition': actions, 'relations':relation_ids,}
-                utils.append_json(out_fname_history, actions_processed)
-                utils.append_json(out_fname, sent_processed)
 
-            else:
-                continue
+def get_pool(workers, vocabs):
+    init_worker(vocabs)
+    if workers <= 1:
+        return None
+    return multiprocessing.Pool(workers, initializer=init_worker, initargs=(vocabs,))
 
 
+def process_data(in_fname_base, out_path, mode, transitions, pool=None, workers=1):
+    # pylint: disable=too-many-arguments
+    in_fname = in_fname_base % mode
+    out_fname = '%s/%s' % (out_path, mode)
+    out_fnames_history = ['%s/%s_actions_%s' % (out_path, transition_name, mode)
+                          for transition_name in transitions]
+    print('Processing: %s' % in_fname)
+
+    chunks = utils.get_chunks(get_sentences(in_fname), CHUNK_SIZE)
+    process_func = partial(process_chunk, transitions=transitions)
+    if pool is not None:
+        results = utils.ordered_imap(pool, process_func, chunks, max_pending=workers * 2)
+    else:
+        results = map(process_func, chunks)
+
+    with ExitStack() as stack:
+        writer = stack.enter_context(ColumnWriter(out_fname, SPLIT_COLUMNS))
+        writers_history = [stack.enter_context(ColumnWriter(fname, ACTION_COLUMNS))
+                           for fname in out_fnames_history]
+        for data, data_history in results:
+            writer.write(data)
+            for writer_history, actions in zip(writers_history, data_history):
+                writer_history.write(actions)
+
+    return writer.fnames, [writer_history.fnames for writer_history in writers_history]
+
 
 def add_sentence_vocab(sentence, words, tags, rels):
-    for token in sentence:
-        words.count_up(token[1])
-        tags.count_up(token[3])
-        tags.count_up(token[4])
-        rels.count_up(token[7])
+    for word, tag1, tag2, _, rel in sentence:
+        words.count_up(word)
+        tags.count_up(tag1)
+        tags.count_up(tag2)
+        rels.count_up(rel)
 
 
 def process_vocabs(words, tags, rels):
@@ -139,8 +173,7 @@ def process_vocabs(words, tags, rels):
 
 
 def add_embedding_vocab(embeddings, words):
-    for word in embeddings.keys():
-        words.add_pretrained(word)
+    words.update_pretrained(embeddings.keys())
 
 
 def get_vocabs(in_fname_base, out_path, min_count, embeddings=None):
@@ -148,9 +181,8 @@ def get_vocabs(in_fname_base, out_path, min_count, embeddings=None):
     words, tags, rels = Vocab(min_count), Vocab(min_count), Vocab(min_count)
     print('Getting vocabs: %s' % in_fname)
 
-    with open(in_fname, 'r') as file:
-        for sentence in get_sentence(file):
-            add_sentence_vocab(sentence, words, tags, rels)
+    for sentence in get_sentences(in_fname):
+        add_sentence_vocab(sentence, words, tags, rels)
 
     if embeddings is not None:
         add_embedding_vocab(embeddings, words)
@@ -160,58 +192,93 @@ def get_vocabs(in_fname_base, out_path, min_count, embeddings=None):
     return (words, tags, rels)
 
 
-def read_embeddings(fname):
-    # loading GloVe
-    embedd_dim = -1
-    embedd_dict = OrderedDict()
-    # with gzip.open(fname, 'rt') as file:
-    with open(fname, 'r') as file:
-        for line in file.readlines():
-            line = line.strip()
-            if len(line) == 0:
-                continue
-
-            tokens = line.split()
-            if embedd_dim < 0:
-                embedd_dim = len(tokens) - 1
-            elif embedd_dim == len(tokens):
-                # Skip empty word
-                continue
-            else:
-                assert embedd_dim + 1 == len(tokens), 'Dimension of embeddings should be consistent'
-
-            embedd = np.empty([1, embedd_dim], dtype=np.float32)
-            embedd[:] = tokens[1:]
-            embedd_dict[tokens[0]] = embedd
-
-    return embedd_dict
+def process_embeddings(src_fname, out_path, workers=1):
+    embeddings = read_embeddings(src_fname, workers=workers)
+    save_embeddings(out_path, embeddings)
+    return embeddings
+
+
+def get_cache(data_path, cache_size):
+    max_size = int(cache_size * 1024 ** 3) if cache_size is not None else None
+    return ArtifactCache(path.join(data_path, constants.UD_PATH_PROCESSED, 'cache'), max_size)
+
+
+def cache_embeddings(cache, glove_file, out_path=None, workers=1):
+    key = cache.get_key('embeddings', cache.file_digest(glove_file))
+    embeddings = None
+    if not cache.contains(key, out_path):
+        with cache.build() as build_path:
+            embeddings = process_embeddings(glove_file, build_path, workers=workers)
+            cache.add(key, utils.get_filenames(build_path), out_path)
+
+    return key, embeddings
+
+
+def cache_vocabs(cache, in_fname, out_path, min_count, embeddings_key, embeddings):
+    key = cache.get_key('vocabs', cache.file_digest(in_fname % 'train'), min_count, embeddings_key)
+    if not cache.contains(key, out_path):
+        if embeddings is None:
+            embeddings = load_embeddings(out_path)
+        with cache.build() as build_path:
+            get_vocabs(in_fname, build_path, min_count=min_count, embeddings=embeddings)
+            cache.add(key, utils.get_filenames(build_path), out_path)
+    return key
+
+
+def cache_splits(cache, in_fname, out_path, transitions, vocabs_key, workers):
+    # pylint: disable=too-many-arguments
+    pool = None
+    for mode in ['train', 'dev', 'test']:
+        digest = cache.file_digest(in_fname % mode)
+        split_key = cache.get_key('split', digest, vocabs_key)
+        actions_keys = OrderedDict([
+            (transition, cache.get_key('actions', digest, vocabs_key, transition))
+            for transition in transitions])
+
+        # Only compute the outputs that are not cached yet
+        missing = [transition for transition, key in actions_keys.items()
+                   if not cache.contains(key, out_path)]
+        if not cache.contains(split_key, out_path) or missing:
+            if pool is None:
+                pool = get_pool(workers, load_vocabs(out_path))
+            with cache.build() as build_path:
+                fnames, fnames_history = process_data(
+                    in_fname, build_path, mode, missing, pool, workers)
+                cache.add(split_key, fnames, out_path)
+                for transition, fnames_actions in zip(missing, fnames_history):
+                    cache.add(actions_keys[transition], fnames_actions, out_path)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def process_language(cache, language, data_path, glove_file, min_count, transitions,
+                     workers=1, embeddings=None):
+    # pylint: disable=too-many-arguments
+    in_fname = path.join(data_path, constants.UD_LANG_FNAMES[language])
+    out_path = path.join(data_path, constants.UD_PATH_PROCESSED, language)
+    utils.mkdir(out_path)
 
+    embeddings_key, built_embeddings = cache_embeddings(cache, glove_file, out_path,
+                                                        workers=workers)
+    if embeddings is None:
+        embeddings = built_embeddings
 
-def process_embeddings(src_fname, out_path):
-    embedding_dict = read_embeddings(src_fname)
-    save_embeddings(out_path, embedding_dict)
-    return embedding_dict
+    vocabs_key = cache_vocabs(cache, in_fname, out_path, min_count, embeddings_key, embeddings)
+    del embeddings, built_embeddings
+    cache_splits(cache, in_fname, out_path, transitions, vocabs_key, workers)
 
 
 def main():
     args = get_args()
 
-    in_fname = path.join(args.data_path, constants.UD_LANG_FNAMES[args.language])
-    out_path = path.join(args.data_path, constants.UD_PATH_PROCESSED, args.language)
-    utils.mkdir(out_path)
-
-    embeddings = process_embeddings(args.glove_file, out_path)
-
-    vocabs = get_vocabs(in_fname, out_path, min_count=args.min_vocab_count, embeddings=embeddings)
-    oracle = None
-    if args.transition == 'arc-standard':
-        oracle = arc_standard_oracle
-    elif args.transition == 'arc-eager':
-        oracle = arc_eager_oracle
+    cache = get_cache(args.data_path, args.cache_size)
+    transitions = list(OrderedDict.fromkeys(args.transition))
+    process_language(cache, args.language, args.data_path, args.glove_file, args.min_vocab_count,
+                     transitions, workers=args.workers)
 
-    process_data(in_fname, out_path, 'train', vocabs, oracle, args.transition)
-    process_data(in_fname, out_path, 'dev', vocabs, oracle, args.transition)
-    process_data(in_fname, out_path, 'test', vocabs, oracle, args.transition)
+    cache.evict()
 
 
 if __name__ == '__main__':
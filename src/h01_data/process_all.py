@@ -0,0 +1,121 @@
+import sys
+import os
+import time
+import json
+import argparse
+import multiprocessing
+from os import path
+from collections import OrderedDict
+
+sys.path.append('./src/')
+from h01_data import load_embeddings
+from h01_data.conllu import count_sentences
+from h01_data.process import ORACLES, get_cache, cache_embeddings, process_language
+from utils import constants
+from utils import utils
+
+# Filled before the pool forks, so every worker shares a single parsed copy
+SHARED = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--languages', type=str, nargs='*', default=None)
+    parser.add_argument('--data-path', type=str, default='data/')
+    parser.add_argument('--glove-file', type=str, required=True)
+    parser.add_argument('--min-vocab-count', type=int, default=2)
+    parser.add_argument('--transition', type=str, nargs='*', choices=list(ORACLES.keys()),
+                        default=['arc-eager'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    # Disk budget for cached artifacts, in GB
+    parser.add_argument('--cache-size', type=float, default=None)
+    return parser.parse_args()
+
+
+def get_file_info(fname, catalog):
+    stat = os.stat(fname)
+    info = catalog.get(fname)
+    if info is None or info['size'] != stat.st_size or info['mtime'] != stat.st_mtime_ns:
+        info = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'sentences': count_sentences(fname)}
+    catalog[fname] = info
+    return info
+
+
+def get_catalog(data_path, languages):
+    # Sizes and sentence counts per language, cached while the files are unchanged
+    catalog_fname = path.join(data_path, constants.UD_PATH_PROCESSED, 'catalog.json')
+    try:
+        with open(catalog_fname, 'r', encoding='utf-8') as file:
+            catalog = json.load(file)
+    except FileNotFoundError:
+        catalog = {}
+
+    languages_info = OrderedDict()
+    for language in languages:
+        in_fname = path.join(data_path, constants.UD_LANG_FNAMES[language])
+        fnames = [in_fname % mode for mode in ['train', 'dev', 'test']]
+        if not all(path.exists(fname) for fname in fnames):
+            print('Skipping %s: treebank not found in %s' % (language, in_fname))
+            continue
+
+        files_info = [get_file_info(fname, catalog) for fname in fnames]
+        languages_info[language] = {
+            'size': sum(info['size'] for info in files_info),
+            'sentences': sum(info['sentences'] for info in files_info),
+        }
+
+    with open(catalog_fname, 'w', encoding='utf-8') as file:
+        json.dump(catalog, file, indent=1, sort_keys=True)
+    return languages_info
+
+
+def run_language(language):
+    args = SHARED['args']
+    start = time.time()
+    process_language(SHARED['cache'], language, args.data_path, args.glove_file,
+                     args.min_vocab_count, SHARED['transitions'], embeddings=SHARED['embeddings'])
+    return language, time.time() - start, SHARED['cache'].used
+
+
+def print_report(catalog, times, total_time):
+    print('\n%-8s %12s %10s %10s %14s %10s' %
+          ('language', 'sentences', 'size (MB)', 'time (s)', 'sentences/s', 'MB/s'))
+    for language, elapsed in sorted(times.items(), key=lambda x: x[1], reverse=True):
+        size = catalog[language]['size'] / 1024 ** 2
+        sentences = catalog[language]['sentences']
+        print('%-8s %12d %10.1f %10.1f %14.1f %10.2f' %
+              (language, sentences, size, elapsed, sentences / elapsed, size / elapsed))
+    print('Total wall time: %.1fs (sum over languages: %.1fs)' % (total_time, sum(times.values())))
+
+
+def main():
+    args = get_args()
+    start = time.time()
+    languages = args.languages if args.languages else list(constants.UD_LANG_FNAMES.keys())
+    utils.mkdir(path.join(args.data_path, constants.UD_PATH_PROCESSED))
+    catalog = get_catalog(args.data_path, languages)
+
+    # Largest languages first, so the longest job never starts last
+    schedule = sorted(catalog, key=lambda x: catalog[x]['size'], reverse=True)
+
+    cache = get_cache(args.data_path, args.cache_size)
+    embeddings_key, embeddings = cache_embeddings(cache, args.glove_file, workers=args.workers)
+    if embeddings is None:
+        embeddings = load_embeddings(cache.get_path(embeddings_key))
+    SHARED.update({'args': args, 'cache': cache, 'embeddings': embeddings,
+                   'transitions': list(OrderedDict.fromkeys(args.transition))})
+
+    times = {}
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for language, elapsed, used in pool.imap_unordered(run_language, schedule, chunksize=1):
+            print('Finished %s in %.1fs' % (language, elapsed))
+            times[language] = elapsed
+            cache.used |= used
+
+    cache.evict()
+    print_report(catalog, times, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
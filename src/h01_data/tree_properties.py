@@ -0,0 +1,77 @@
+import numpy as np
+
+# Max number of cells in a [batch, length, length] comparison before splitting the batch
+MAX_ELEMENTS = 2 ** 24
+
+
+def pad_heads(heads_list):
+    # heads_list contains one list of heads per sentence, with the root at
+    # position 0. Padded positions point to themselves, so their arcs are empty.
+    lengths = np.array([len(heads) for heads in heads_list], dtype=np.int64)
+    heads = np.tile(np.arange(lengths.max(), dtype=np.int64), (len(heads_list), 1))
+    heads[get_mask(lengths, lengths.max())] = np.concatenate(heads_list)
+    return heads, lengths
+
+
+def get_mask(lengths, max_length):
+    return np.arange(max_length) < lengths[:, None]
+
+
+def count_crossings(heads):
+    # Two arcs cross iff one has exactly one endpoint strictly inside the other
+    nodes = np.arange(heads.shape[1])
+    low, high = np.minimum(heads, nodes), np.maximum(heads, nodes)
+    low_a, high_a = low[:, :, None], high[:, :, None]
+    low_b, high_b = low[:, None, :], high[:, None, :]
+    crossing = (low_a < low_b) & (low_b < high_a) & (high_a < high_b)
+    return crossing.sum(axis=(1, 2))
+
+
+def contains_cycles(heads, lengths):
+    # Pointer jumping: after log2(n) squarings, every node of a tree reaches the root
+    ancestors = heads.copy()
+    for _ in range(int(np.ceil(np.log2(max(heads.shape[1], 2)))) + 1):
+        ancestors = np.take_along_axis(ancestors, ancestors, axis=1)
+    unreached = (ancestors != 0) & get_mask(lengths, heads.shape[1])
+    return unreached.any(axis=1)
+
+
+def count_roots(heads, lengths):
+    is_root = (heads == 0) & get_mask(lengths, heads.shape[1])
+    return is_root[:, 1:].sum(axis=1)
+
+
+def get_batches(lengths):
+    # Group sentences of similar length, so padding and memory stay bounded
+    order = np.argsort(lengths, kind='stable')
+    start = 0
+    while start < len(order):
+        end = start + 1
+        # Sentences are sorted, so the last one in a batch is the longest
+        while end < len(order) and \
+                (end - start + 1) * lengths[order[end]] ** 2 <= MAX_ELEMENTS:
+            end += 1
+        yield order[start:end]
+        start = end
+
+
+def map_batches(heads_list, func, dtype):
+    # Applies func(heads, lengths) to padded batches of sentences, in the original order
+    lengths = np.array([len(heads) for heads in heads_list], dtype=np.int64)
+    results = np.zeros(len(heads_list), dtype=dtype)
+    for batch in get_batches(lengths):
+        heads, batch_lengths = pad_heads([heads_list[i] for i in batch])
+        results[batch] = func(heads, batch_lengths)
+    return results
+
+
+def get_tree_properties(heads_list):
+    # Well-formedness checks, which projectivity does not need
+    return {
+        'cycles': map_batches(heads_list, contains_cycles, bool),
+        'roots': map_batches(heads_list, count_roots, np.int64),
+    }
+
+
+def is_projective_batch(heads_list):
+    return map_batches(heads_list, lambda heads, _: count_crossings(heads), np.int64) == 0
@@ -0,0 +1,94 @@
+import os
+from collections import OrderedDict
+import numpy as np
+
+# Processed splits are stored column by column, as flat binary arrays with
+# one file per column. Columns in the same group share an offsets column,
+# where sentence i spans [offsets[i], offsets[i + 1]).
+SPLIT_COLUMNS = OrderedDict([
+    ('words', np.int32),
+    ('tags1', np.int32),
+    ('tags2', np.int32),
+    ('heads', np.int32),
+    ('rels', np.int32),
+    ('offsets', np.int64),
+])
+ACTION_COLUMNS = OrderedDict([
+    ('transitions', np.int8),
+    ('transition_offsets', np.int64),
+    ('relations', np.int32),
+    ('relation_offsets', np.int64),
+])
+# Column whose per sentence lengths each offsets column indexes
+OFFSETS = {
+    'offsets': 'words',
+    'transition_offsets': 'transitions',
+    'relation_offsets': 'relations',
+}
+
+
+def get_column_fname(fname_base, column):
+    return '%s.%s.bin' % (fname_base, column)
+
+
+def is_offsets(column):
+    return column in OFFSETS
+
+
+def concat_rows(rows, columns):
+    # Joins the columns of several sentences into flat arrays, with
+    # offsets columns holding sentence lengths
+    data = {}
+    for column, dtype in columns.items():
+        if is_offsets(column):
+            data[column] = np.array([len(row[OFFSETS[column]]) for row in rows], dtype=np.int64)
+        elif rows:
+            data[column] = np.concatenate([row[column] for row in rows]).astype(dtype, copy=False)
+        else:
+            data[column] = np.zeros(0, dtype=dtype)
+    return data
+
+
+class ColumnWriter:
+    # Appends chunks of sentences to the column files. Chunks give offsets
+    # columns as sentence lengths, which are accumulated here.
+    def __init__(self, fname_base, columns):
+        self.columns = columns
+        self.fnames = [get_column_fname(fname_base, column) for column in columns]
+        self.files = [open(fname, 'wb') for fname in self.fnames]
+        self.totals = {column: 0 for column in columns if is_offsets(column)}
+        for column, file in zip(self.columns, self.files):
+            if is_offsets(column):
+                np.zeros(1, dtype=self.columns[column]).tofile(file)
+
+    def write(self, data):
+        for column, file in zip(self.columns, self.files):
+            values = data[column]
+            if is_offsets(column):
+                values = np.cumsum(values, dtype=np.int64) + self.totals[column]
+                if len(values) > 0:
+                    self.totals[column] = values[-1]
+            np.asarray(values, dtype=self.columns[column]).tofile(file)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_column(fname_base, column, columns):
+    fname = get_column_fname(fname_base, column)
+    # np.memmap can not map empty files
+    if os.path.getsize(fname) == 0:
+        return np.zeros(0, dtype=columns[column])
+    return np.memmap(fname, dtype=columns[column], mode='r')
+
+
+def load_columns(fname_base, columns, names):
+    # Memory-maps only the requested columns, read-only
+    return [load_column(fname_base, name, columns) for name in names]
@@ -1,7 +1,10 @@
+import numpy as np
+
 
 class Vocab:
     # pylint: disable=invalid-name,too-many-instance-attributes
     ROOT = '<ROOT>'
+    UNK = '<UNK>'
     SPECIAL_TOKENS = ('<PAD>', '<ROOT>', '<UNK>')
 
     def __init__(self, min_count=None):
@@ -10,32 +13,137 @@ class Vocab:
         self.min_count = min_count
         self.size = 3
 
+        # Set by process_vocab, or lazily after unpickling
+        self._types = None
+        self._vocab = None
+        self._table = None
+        self.counts = None
+
     def idx(self, token):
-        if token not in self._vocab:
-            return self._vocab['<UNK>']
-        return self._vocab[token]
+        vocab = self.word2idx
+        if token not in vocab:
+            return vocab[self.UNK]
+        return vocab[token]
+
+    def encode(self, tokens):
+        # Maps a whole column of tokens to ids, with unknown tokens mapped to <UNK>
+        vocab = self.word2idx
+        unk = vocab[self.UNK]
+        return np.fromiter((vocab.get(token, unk) for token in tokens),
+                           dtype=np.int32, count=len(tokens))
 
     def count_up(self, token):
         self._counts[token] = self._counts.get(token, 0) + 1
 
     def add_pretrained(self, token):
-        self._pretrained |= set([token])
+        self._pretrained.add(token)
+
+    def update_pretrained(self, tokens):
+        self._pretrained.update(tokens)
 
     def process_vocab(self):
-        self._counts_raw = self._counts
         if self.min_count:
             self._counts = {k: count for k, count in self._counts.items()
                             if count > self.min_count}
 
         words = [x[0] for x in sorted(self._counts.items(), key=lambda x: x[1], reverse=True)]
         pretrained = [x for x in self._pretrained if x not in self._counts]
-        types = list(self.SPECIAL_TOKENS) + words + pretrained
+        self.set_types(list(self.SPECIAL_TOKENS) + words + pretrained)
+
+    def set_types(self, types):
+        self._types = types
+        self.counts = np.array([self._counts.get(x, 0) for x in self._types], dtype=np.int32)
 
-        self._vocab = {x: i for i, x in enumerate(types)}
-        self._idx2word = {idx: word for word, idx in self._vocab.items()}
+        self._vocab = {x: i for i, x in enumerate(self._types)}
         self.ROOT_IDX = self._vocab[self.ROOT]
         self.size = len(self._vocab)
 
+    @classmethod
+    def merge(cls, vocabs):
+        # Joins processed vocabs, with counted types sorted by their total count
+        # and pretrained only types after them, in a deterministic order.
+        # Returns the merged vocab, and per vocab an array mapping its ids to merged ids.
+        merged = cls(vocabs[0].min_count)
+        pretrained = {}
+        for vocab in vocabs:
+            for word, count in zip(vocab.types, vocab.counts.tolist()):
+                if word in cls.SPECIAL_TOKENS:
+                    continue
+                if count > 0:
+                    merged._counts[word] = merged._counts.get(word, 0) + count
+                else:
+                    pretrained[word] = True
+
+        words = sorted(merged._counts, key=merged._counts.get, reverse=True)
+        pretrained = [x for x in pretrained if x not in merged._counts]
+        merged._pretrained = set(pretrained)
+        merged.set_types(list(cls.SPECIAL_TOKENS) + words + pretrained)
+
+        remaps = [merged.encode(vocab.types) for vocab in vocabs]
+        return merged, remaps
+
+    @property
+    def types(self):
+        if self._types is None:
+            text, offsets = self._table
+            self._types = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            self._table = None
+        return self._types
+
+    @property
+    def word2idx(self):
+        if self._vocab is None:
+            self._vocab = {x: i for i, x in enumerate(self.types)}
+        return self._vocab
+
+    @property
+    def train_size(self):
+        # Special tokens and words counted in training come before pretrained only words
+        n_special = len(self.SPECIAL_TOKENS)
+        return n_special + int(np.count_nonzero(self.counts[n_special:]))
+
     def items(self):
-        for word, idx in self._vocab.items():
+        for idx, word in enumerate(self.types):
             yield word, idx
+
+    def __getstate__(self):
+        if self._types is None and self._table is None:
+            # Not processed yet
+            return self.__dict__
+
+        # Types are saved as one string plus offsets, without raw counts
+        types = self.types
+        offsets = np.zeros(len(types) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in types], out=offsets[1:])
+        return {
+            'min_count': self.min_count,
+            'ROOT_IDX': self.ROOT_IDX,
+            'table': ''.join(types).encode('utf-8'),
+            'offsets': offsets,
+            'counts': self.counts,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['min_count'])
+        if 'table' not in state:
+            self.load_legacy_state(state)
+            return
+
+        offsets = state['offsets']
+        self._table = (state['table'].decode('utf-8'), offsets.tolist())
+        self.counts = state['counts']
+        self.ROOT_IDX = state['ROOT_IDX']
+        self.size = len(offsets) - 1
+
+    def load_legacy_state(self, state):
+        # Vocabs pickled before the compact format kept the full dicts
+        if state.get('_vocab') is None:
+            self.__dict__.update(state)
+            return
+
+        counts = state['_counts']
+        self._vocab = state['_vocab']
+        self._types = sorted(self._vocab, key=self._vocab.get)
+        self.counts = np.array([counts.get(x, 0) for x in self._types], dtype=np.int32)
+        self.ROOT_IDX = state['ROOT_IDX']
+        self.size = state['size']
@@ -123,7 +123,7 @@ def get_sentence_mst(logprob):
     parents = np.zeros(length, np.int32)
     incoming = np.zeros([length, length], dtype=np.int32)
     outgoing = np.zeros([length, length], dtype=np.int32)
-    curr_nodes = np.ones([length], dtype=np.bool)
+    curr_nodes = np.ones([length], dtype=bool)
     nodes_reached = [{source} for source in range(length)]
     np.fill_diagonal(logprob, 0)  # Remove self edges
     for source in range(length):
@@ -1,79 +1,202 @@
 from os import path
-from torch.utils.data import DataLoader
+from functools import partial
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
 
-from h01_data import load_vocabs, load_embeddings, get_ud_fname, get_oracle_actions
+from h01_data import load_vocabs, load_merged_vocabs, load_shared_embeddings, get_ud_fname, \
+    get_oracle_actions
 from utils import constants
 from .syntax import SyntaxDataset
+from .sampler import BucketBatchSampler, TokenBudgetBatchSampler, TemperatureBatchSampler
+from .prefetch import DevicePrefetcher
+from .stream import StreamingSyntaxDataset
+from .multi import MultiSyntaxDataset
+from .precollated import PrecollatedLoader
 
 
-def generate_batch(batch):
+# Padding value of each field built by generate_batch
+FIELDS = OrderedDict([
+    ('text', 0),
+    ('pos', 0),
+    ('heads', -1),
+    ('rels', 0),
+    ('transitions', -1),
+    ('relations_in_order', 0),
+])
+# Graph-based parsers do not use oracle actions
+GRAPH_FIELDS = ('text', 'pos', 'heads', 'rels')
+
+
+def pad_field(data, pad_value, min_length=0):
+    # Builds the padded [batch, max_length] tensor with a single scatter of the flat data
+    lengths = np.array([len(entry) for entry in data], dtype=np.int64)
+    max_length = max(lengths.max(), min_length)
+    padded = np.full([len(data), max_length], pad_value, dtype=np.int64)
+    padded[np.arange(max_length) < lengths[:, None]] = np.concatenate(data)
+    return torch.from_numpy(padded)
+
+
+def generate_batch(batch, fields=tuple(FIELDS.keys())):
     r"""
-    Since the text entries have different lengths, a custom function
-    generate_batch() is used to generate data batches and offsets,
-    which are compatible with EmbeddingBag. The function is passed
-    to 'collate_fn' in torch.utils.data.DataLoader. The input to
-    'collate_fn' is a list of tensors with the size of batch_size,
-    and the 'collate_fn' function packs them into a mini-batch.[len(entry[0][0]) for entry in batch]
-    Pay attention here and make sure that 'collate_fn' is declared
-    as a top level def. This ensures that the function is available
-    in each worker.
+    Pads a list of sentences into batch tensors, and is passed to 'collate_fn'
+    in torch.utils.data.DataLoader. Each field is built from the flat data of
+    all sentences plus their lengths, and fields not listed in 'fields' are
+    returned as None. Tensors stay on the CPU, DevicePrefetcher moves them.
     Output:
-        text: the text entries in the data_batch are packed into a list and
-            concatenated as a single tensor for the input of nn.EmbeddingBag.
-        offsets: the offsets is a tensor of delimiters to represent the beginning
-            index of the individual sequence in the text tensor.
-        cls: a tensor saving the labels of individual text entries.
+        (text, pos), (heads, rels), (transitions, relations_in_order)
     """
-    tensor = batch[0][0][0]
-
-    #for entry in batch:
-    #    print(entry[2])
-    batch_size = len(batch)
-    max_length = max([len(entry[0][0]) for entry in batch])
-    max_length_actions = max([len(entry[2][0]) for entry in batch])
-    text = tensor.new_zeros(batch_size, max_length)
-    pos = tensor.new_zeros(batch_size, max_length)
-    heads = tensor.new_ones(batch_size, max_length) * -1
-    rels = tensor.new_zeros(batch_size, max_length)
-    transitions = tensor.new_ones(batch_size,max_length_actions) * -1
-    relations_in_order = tensor.new_zeros(batch_size,max_length)
-    for i, sentence in enumerate(batch):
-        sent_len = len(sentence[0][0])
-        text[i, :sent_len] = sentence[0][0]
-        pos[i, :sent_len] = sentence[0][1]
-        heads[i, :sent_len] = sentence[1][0]
-        rels[i, :sent_len] = sentence[1][1]
-
-
-    for i, sentence in enumerate(batch):
-        num_actions = len(sentence[2][0])
-        #print(num_actions)
-        transitions[i,:num_actions] = sentence[2][0]
-        num_rels = len(sentence[2][1])
-        relations_in_order[i, :num_rels] = sentence[2][1]
+    columns = dict(zip(FIELDS.keys(), zip(*[entry[0] + entry[1] + entry[2] for entry in batch])))
+    max_length = max(len(words) for words in columns['text'])
 
+    tensors = {}
+    for field in fields:
+        # relations_in_order keeps the width of the sentences, as before
+        min_length = max_length if field == 'relations_in_order' else 0
+        tensors[field] = pad_field(columns[field], FIELDS[field], min_length)
 
+    text, pos, heads, rels, transitions, relations_in_order = [
+        tensors.get(field) for field in FIELDS]
     return (text, pos), (heads, rels), (transitions, relations_in_order)
 
 
-def get_data_loader(fname, transitions_file,transition_system,batch_size, shuffle):
-    dataset = SyntaxDataset(fname,transitions_file,transition_system)
-    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                      collate_fn=generate_batch)
+def get_sampler(lengths, batch_size, shuffle, batch_tokens=None, batch_cost='tokens'):
+    # Padding waste is only reported for training, not on every evaluation
+    if batch_tokens is not None:
+        return TokenBudgetBatchSampler(lengths, batch_tokens, cost=batch_cost, shuffle=shuffle,
+                                       report=shuffle)
+    return BucketBatchSampler(lengths, batch_size, shuffle=shuffle, report=shuffle)
+
+
+def get_data_loader(fname, transitions_file, batch_size, shuffle, batch_tokens=None,
+                    batch_cost='tokens', num_workers=0, pin_memory=False, stream=False,
+                    shuffle_buffer=100000):
+    # pylint: disable=too-many-arguments
+    fields = tuple(FIELDS.keys()) if transitions_file is not None else GRAPH_FIELDS
+    collate_fn = partial(generate_batch, fields=fields)
+    if stream:
+        # The dataset batches sentences itself, so the loader only collates
+        get_pool_sampler = partial(get_sampler, batch_size=batch_size, shuffle=shuffle,
+                                   batch_tokens=batch_tokens, batch_cost=batch_cost)
+        dataset = StreamingSyntaxDataset(fname, transitions_file, get_pool_sampler,
+                                         buffer_size=shuffle_buffer, shuffle=shuffle)
+        loader = DataLoader(dataset, batch_size=None, collate_fn=collate_fn,
+                            num_workers=num_workers, pin_memory=pin_memory)
+        return DevicePrefetcher(loader, constants.device)
+
+    dataset = SyntaxDataset(fname, transitions_file)
+    sampler = get_sampler(dataset.lengths, batch_size, shuffle, batch_tokens, batch_cost)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn,
+                        num_workers=num_workers, pin_memory=pin_memory)
+    return DevicePrefetcher(loader, constants.device)
+
+
+def get_sample_loader(dataset, n_sentences, batch_size, batch_tokens=None, batch_cost='tokens',
+                      random_state=np.random):
+    # pylint: disable=too-many-arguments
+    # Loads a random subset of n_sentences sentences of a (non streamed) dataset,
+    # length sorted like the evaluation loaders
+    n_sentences = min(n_sentences, len(dataset))
+    indices = np.sort(random_state.choice(len(dataset), n_sentences, replace=False))
+    fields = tuple(FIELDS.keys()) if dataset.transition_file is not None else GRAPH_FIELDS
+    sampler = get_sampler(dataset.lengths[indices], batch_size, False, batch_tokens, batch_cost)
+    loader = DataLoader(Subset(dataset, indices), batch_sampler=sampler,
+                        collate_fn=partial(generate_batch, fields=fields))
+    return DevicePrefetcher(loader, constants.device)
+
+
+def get_multi_sampler(dataset, batch_size, shuffle, batch_tokens=None, batch_cost='tokens',
+                      temperature=1.):
+    # pylint: disable=too-many-arguments
+    # Each treebank is batched by its own sampler, which only draws its batches
+    samplers = [get_sampler(data.lengths, batch_size, shuffle, batch_tokens, batch_cost)
+                for data in dataset.datasets]
+    return TemperatureBatchSampler(samplers, dataset.starts, temperature, shuffle=shuffle,
+                                   report=shuffle)
+
+
+def get_full_loader(dataset, batch_size, batch_tokens=None, batch_cost='tokens'):
+    # Loads every sentence of a (non streamed) dataset once, length sorted like the
+    # evaluation loaders, and one treebank after the other
+    fields = tuple(FIELDS.keys()) if dataset.transition_file is not None else GRAPH_FIELDS
+    if isinstance(dataset, MultiSyntaxDataset):
+        sampler = get_multi_sampler(dataset, batch_size, False, batch_tokens, batch_cost)
+    else:
+        sampler = get_sampler(dataset.lengths, batch_size, False, batch_tokens, batch_cost)
+    loader = DataLoader(dataset, batch_sampler=sampler,
+                        collate_fn=partial(generate_batch, fields=fields))
+    return DevicePrefetcher(loader, constants.device)
+
+
+def get_multi_data_loader(names, fnames, transitions_files, remaps, batch_size, shuffle,
+                          batch_tokens=None, batch_cost='tokens', num_workers=0, pin_memory=False,
+                          temperature=1.):
+    # pylint: disable=too-many-arguments
+    # Loads several treebanks together, see TemperatureBatchSampler for how their batches are drawn
+    datasets = [SyntaxDataset(fname, transitions_file, remap)
+                for fname, transitions_file, remap in zip(fnames, transitions_files, remaps)]
+    dataset = MultiSyntaxDataset(names, datasets)
+    sampler = get_multi_sampler(dataset, batch_size, shuffle, batch_tokens, batch_cost,
+                                temperature)
+
+    fields = tuple(FIELDS.keys()) if dataset.transition_file is not None else GRAPH_FIELDS
+    loader = DataLoader(dataset, batch_sampler=sampler,
+                        collate_fn=partial(generate_batch, fields=fields),
+                        num_workers=num_workers, pin_memory=pin_memory)
+    return DevicePrefetcher(loader, constants.device)
+
+
+def get_split_loader(names, fnames, transitions_files, remaps, batch_size, shuffle, **kwargs):
+    # pylint: disable=too-many-arguments
+    if len(fnames) == 1:
+        return get_data_loader(fnames[0], transitions_files[0], batch_size, shuffle, **kwargs)
+    return get_multi_data_loader(names, fnames, transitions_files, remaps, batch_size, shuffle,
+                                 **kwargs)
+
+
+def get_data_loaders(data_path, languages, batch_size, batch_size_eval, transitions=None,
+                     batch_tokens=None, batch_tokens_eval=None, batch_cost='tokens',
+                     num_workers=0, pin_memory=False, stream=False, shuffle_buffer=100000,
+                     temperature=1.):
+    # pylint: disable=too-many-arguments,too-many-locals
+    # Languages is a language, or a list of languages or treebanks which are
+    # loaded together, with merged vocabs and one shared embedding store
+    languages = [languages] if isinstance(languages, str) else list(languages)
+    if stream and len(languages) > 1:
+        raise ValueError('Only a single treebank can be streamed')
 
+    src_paths = [path.join(data_path, constants.UD_PATH_PROCESSED, language)
+                 for language in languages]
+    for src_path in src_paths:
+        print(src_path)
+    if len(src_paths) == 1:
+        vocabs, remaps = load_vocabs(src_paths[0]), [None]
+    else:
+        vocabs, remaps = load_merged_vocabs(src_paths)
+    embeddings = load_shared_embeddings(src_paths)
 
-def get_data_loaders(data_path, language, batch_size, batch_size_eval, transitions=None,transition_system=None):
-    src_path = path.join(data_path, constants.UD_PATH_PROCESSED, language)
-    print(src_path)
-    vocabs = load_vocabs(src_path)
-    embeddings = load_embeddings(src_path)
-    (fname_train, fname_dev, fname_test) = get_ud_fname(src_path)
-    transitions_train, transitions_dev, transitions_test = None, None, None
+    # File names of each split, for every treebank
+    fnames = list(zip(*[get_ud_fname(src_path) for src_path in src_paths]))
+    transitions_fnames = [[None] * len(src_paths)] * 3
     if transitions is not None:
-        (transitions_train, transitions_dev, transitions_test) = get_oracle_actions(src_path,transitions)
+        transitions_fnames = list(zip(*[get_oracle_actions(src_path, transitions)
+                                        for src_path in src_paths]))
 
-    trainloader = get_data_loader(fname_train,transitions_train, transition_system,batch_size, shuffle=True)
-    devloader = get_data_loader(fname_dev,transitions_dev, transition_system,batch_size_eval, shuffle=False)
-    testloader = get_data_loader(fname_test,transitions_test, transition_system,batch_size_eval, shuffle=False)
+    loader_args = {'batch_cost': batch_cost, 'num_workers': num_workers, 'pin_memory': pin_memory}
+    if len(src_paths) > 1:
+        loader_args['temperature'] = temperature
+    # Only training streams, dev and test sets are small
+    train_args = {'stream': stream, 'shuffle_buffer': shuffle_buffer} if stream else {}
+    trainloader = get_split_loader(
+        languages, fnames[0], transitions_fnames[0], remaps, batch_size, shuffle=True,
+        batch_tokens=batch_tokens, **train_args, **loader_args)
+    # Evaluation batches are length sorted, collated once and reused by every evaluation
+    devloader = PrecollatedLoader(get_split_loader(
+        languages, fnames[1], transitions_fnames[1], remaps, batch_size_eval, shuffle=False,
+        batch_tokens=batch_tokens_eval, **loader_args))
+    testloader = PrecollatedLoader(get_split_loader(
+        languages, fnames[2], transitions_fnames[2], remaps, batch_size_eval, shuffle=False,
+        batch_tokens=batch_tokens_eval, **loader_args))
 
     return trainloader, devloader, testloader, vocabs, embeddings
@@ -0,0 +1,30 @@
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class MultiSyntaxDataset(Dataset):
+    # Concatenates the datasets of several treebanks, whose ids were all
+    # remapped to the same merged vocabs. Sentence i of treebank t is at
+    # index starts[t] + i.
+    def __init__(self, names, datasets):
+        self.names = names
+        self.datasets = datasets
+        sizes = [len(dataset) for dataset in datasets]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.treebanks = np.repeat(np.arange(len(datasets)), sizes)
+
+    @property
+    def lengths(self):
+        return np.concatenate([dataset.lengths for dataset in self.datasets])
+
+    @property
+    def transition_file(self):
+        # All treebanks are trained with the same parser
+        return self.datasets[0].transition_file
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, index):
+        treebank = self.treebanks[index]
+        return self.datasets[treebank][index - self.starts[treebank]]
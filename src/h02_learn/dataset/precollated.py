@@ -0,0 +1,23 @@
+class PrecollatedLoader:
+    # Collates the batches of an evaluation loader on the first pass, and
+    # replays the same batches, already on the device, on every later pass.
+    # The wrapped loader must not shuffle.
+    def __init__(self, loader):
+        self.loader = loader
+        self.batches = None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_sampler(self):
+        return self.loader.batch_sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = list(self.loader)
+        return iter(self.batches)
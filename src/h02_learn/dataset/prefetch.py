@@ -0,0 +1,53 @@
+import torch
+
+
+class DevicePrefetcher:
+    # Wraps a DataLoader and copies batch N+1 to the device while batch N is
+    # being used. On GPUs, copies run on a side stream, and are asynchronous
+    # when the loader pins memory. On CPUs batches are returned as they are.
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_sampler(self):
+        return self.loader.batch_sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        return tuple(
+            tuple(tensor.to(device=self.device, non_blocking=True) if tensor is not None else None
+                  for tensor in group)
+            for group in batch)
+
+    def preload(self, iterator):
+        batch = next(iterator, None)
+        if batch is None or self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def wait(self, batch):
+        # Make the current stream wait for the copy, and keep the memory alive until it is used
+        torch.cuda.current_stream().wait_stream(self.stream)
+        for group in batch:
+            for tensor in group:
+                if tensor is not None:
+                    tensor.record_stream(torch.cuda.current_stream())
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self.preload(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                self.wait(batch)
+            next_batch = self.preload(iterator)
+            yield batch
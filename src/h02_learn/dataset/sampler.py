@@ -0,0 +1,149 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+BATCH_COSTS = ['tokens', 'n2']
+
+
+def get_padding_counts(lengths, batches):
+    # Tokens and padded tokens, then cells and padded cells of the n^2 arc score matrices
+    counts = np.zeros(4, dtype=np.int64)
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        max_length = batch_lengths.max()
+        counts += [batch_lengths.sum(), len(batch) * max_length,
+                   (batch_lengths ** 2).sum(), len(batch) * max_length ** 2]
+    return counts
+
+
+def get_padding_waste(counts):
+    # Fraction of padded tokens, and of padded cells in the n^2 arc score matrices
+    tokens, tokens_padded, cells, cells_padded = counts
+    return 1 - tokens / max(tokens_padded, 1), 1 - cells / max(cells_padded, 1)
+
+
+def report_padding_waste(counts):
+    tokens_waste, cells_waste = get_padding_waste(counts)
+    print('\tPadding waste: %.1f%% of tokens, %.1f%% of arc scores' %
+          (tokens_waste * 100, cells_waste * 100))
+
+
+def get_batch_cost(n_sentences, max_length, cost):
+    # Cost of a padded batch, in tokens or in arc score cells
+    if cost == 'n2':
+        return n_sentences * max_length ** 2
+    return n_sentences * max_length
+
+
+class BucketBatchSampler(Sampler):
+    # pylint: disable=super-init-not-called
+    # Batches sentences of similar length together, so little of each batch
+    # is padding. When shuffling, sentences are split at random into buckets
+    # of bucket_batches batches and sorted by length inside each bucket, then
+    # the batches of all buckets are shuffled together. Sentences in a batch
+    # are sorted from longest to shortest.
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=100, report=False):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.report = report
+
+    def split(self, bucket):
+        # Splits a bucket sorted by decreasing length into batches
+        return [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+
+    def get_batches(self, random_state=np.random):
+        if not self.shuffle:
+            return self.split(np.argsort(-self.lengths, kind='stable'))
+
+        order = random_state.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            batches += self.split(bucket[np.argsort(-self.lengths[bucket], kind='stable')])
+        return [batches[i] for i in random_state.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.get_batches()
+        if self.report:
+            report_padding_waste(get_padding_counts(self.lengths, batches))
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    # Batches as many sentences as fit in a budget of padded tokens, or of
+    # padded n^2 arc score cells, instead of a fixed number of sentences.
+    # Sentences longer than the budget get a batch of their own.
+    def __init__(self, lengths, max_cost, cost='tokens', shuffle=True, bucket_batches=100,
+                 report=False):
+        # pylint: disable=too-many-arguments
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_cost = max_cost
+        self.cost = cost
+        # Buckets hold about bucket_batches batches of average length sentences
+        avg_cost = get_batch_cost(1, lengths.mean() if len(lengths) else 1, cost)
+        batch_size = max(int(max_cost // avg_cost), 1)
+        super().__init__(lengths, batch_size, shuffle=shuffle, bucket_batches=bucket_batches,
+                         report=report)
+
+    def split(self, bucket):
+        batches, start = [], 0
+        while start < len(bucket):
+            # The bucket is sorted, so the first sentence is the longest
+            max_length = self.lengths[bucket[start]]
+            size = max(int(self.max_cost // get_batch_cost(1, max_length, self.cost)), 1)
+            batches += [bucket[start:start + size]]
+            start += size
+        return batches
+
+    def __len__(self):
+        # The number of batches changes between epochs, this counts them for one global sort
+        return len(self.split(np.argsort(-self.lengths, kind='stable')))
+
+
+class TemperatureBatchSampler(Sampler):
+    # pylint: disable=super-init-not-called
+    # Draws the batches of several treebanks, each batched by its own sampler.
+    # When shuffling, each batch comes from treebank t with probability
+    # proportional to size_t ** (1 / temperature), restarting treebanks that
+    # run out, so temperature 1 follows the treebank sizes and higher ones
+    # upsample small treebanks. Otherwise treebanks are batched in order.
+    def __init__(self, samplers, starts, temperature=1., shuffle=True, report=False):
+        # pylint: disable=too-many-arguments
+        self.samplers = samplers
+        self.starts = starts
+        self.shuffle = shuffle
+        self.report = report
+        sizes = np.array([len(sampler.lengths) for sampler in samplers], dtype=np.float64)
+        weights = sizes ** (1. / temperature)
+        self.probs = weights / weights.sum()
+
+    def get_treebank_batches(self, treebank, random_state):
+        while True:
+            for batch in self.samplers[treebank].get_batches(random_state):
+                yield batch + self.starts[treebank]
+
+    def get_batches(self, random_state=np.random):
+        if not self.shuffle:
+            return [batch + start for sampler, start in zip(self.samplers, self.starts)
+                    for batch in sampler.get_batches(random_state)]
+
+        iterators = [self.get_treebank_batches(treebank, random_state)
+                     for treebank in range(len(self.samplers))]
+        treebanks = random_state.choice(len(self.samplers), len(self), p=self.probs)
+        return [next(iterators[treebank]) for treebank in treebanks]
+
+    def __iter__(self):
+        batches = self.get_batches()
+        if self.report:
+            lengths = np.concatenate([sampler.lengths for sampler in self.samplers])
+            report_padding_waste(get_padding_counts(lengths, batches))
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return sum(len(sampler) for sampler in self.samplers)
@@ -0,0 +1,81 @@
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils import utils
+from .syntax import SyntaxDataset
+from .sampler import get_padding_counts, report_padding_waste
+
+
+class StreamingSyntaxDataset(IterableDataset):
+    # pylint: disable=abstract-method
+    # Streams sentences from disk for corpora too large to index in memory.
+    # Sentences are read in blocks, which are split between DataLoader
+    # workers, and shuffled through a bounded buffer. Every pool_size
+    # sentences are then batched by get_sampler, so batches still group
+    # sentences of similar length. Yields lists of sentences, one per batch,
+    # so it has no length, its sentences are counted by self.dataset.
+    BLOCK_SIZE = 1000
+
+    def __init__(self, fname, transition_file, get_sampler, buffer_size=100000, pool_size=10000,
+                 shuffle=True):
+        # pylint: disable=too-many-arguments
+        self.dataset = SyntaxDataset(fname, transition_file)
+        self.get_sampler = get_sampler
+        self.buffer_size = buffer_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+
+    @staticmethod
+    def get_random_state():
+        # Workers get a different seed on every epoch, numpy's global state does not
+        info = get_worker_info()
+        if info is None:
+            return np.random
+        return np.random.RandomState(info.seed % 2 ** 32)  # pylint: disable=no-member
+
+    def get_blocks(self, random_state):
+        blocks = np.arange(0, len(self.dataset), self.BLOCK_SIZE)
+        info = get_worker_info()
+        if info is not None:
+            blocks = blocks[info.id::info.num_workers]
+        if self.shuffle:
+            blocks = blocks[random_state.permutation(len(blocks))]
+        return blocks
+
+    def iter_sentences(self, random_state):
+        for start in self.get_blocks(random_state):
+            for index in range(start, min(start + self.BLOCK_SIZE, len(self.dataset))):
+                yield self.dataset[index]
+
+    def iter_shuffled(self, random_state):
+        # Once the buffer is full, each new sentence replaces a random one, which is yielded
+        buffer = []
+        for sentence in self.iter_sentences(random_state):
+            if len(buffer) < self.buffer_size:
+                buffer += [sentence]
+                continue
+            index = random_state.randint(len(buffer))
+            yield buffer[index]
+            buffer[index] = sentence
+
+        for index in random_state.permutation(len(buffer)):
+            yield buffer[index]
+
+    def __iter__(self):
+        random_state = self.get_random_state()
+        if self.shuffle:
+            sentences = self.iter_shuffled(random_state)
+        else:
+            sentences = self.iter_sentences(random_state)
+        # Padding waste is summed over the pools, and reported once they are all batched
+        counts, report = 0, False
+        for pool in utils.get_chunks(sentences, self.pool_size):
+            lengths = np.array([len(sentence[0][0]) for sentence in pool], dtype=np.int64)
+            sampler = self.get_sampler(lengths)
+            batches = sampler.get_batches(random_state)
+            if sampler.report:
+                counts, report = counts + get_padding_counts(lengths, batches), True
+            for batch in batches:
+                yield [pool[index] for index in batch]
+        if report:
+            report_padding_waste(counts)
@@ -1,66 +1,59 @@
-import json
-import torch
+import numpy as np
 from torch.utils.data import Dataset
 
-from utils import constants
+from h01_data.treebank import SPLIT_COLUMNS, ACTION_COLUMNS, load_columns
 
 
 class SyntaxDataset(Dataset):
-    def __init__(self, fname, transition_file, transition_system):
+    def __init__(self, fname, transition_file, remaps=None):
         self.fname = fname
         self.transition_file = transition_file
-        self.transition_system = {act: i for (act, i) in zip(transition_system[0], transition_system[1])}
-        self.transition_system[None] = -2
+        # Arrays mapping word, tag and relation ids to the ids of merged vocabs
+        self.remaps = remaps
         self.load_data(fname, transition_file)
-        self.n_instances = len(self.words)
+        self.n_instances = len(self.offsets) - 1
 
     def load_data(self, fname, transition_file):
-        self.words, self.pos, self.heads, self.rels = [], [], [], []
-        self.actions = []
-        self.relations_in_order = []
-        #self.labeled_actions = []
-        with open(fname, 'r') as file, open(transition_file, 'r') as file2:
-            for line, action in zip(file.readlines(), file2.readlines()):
-                sentence = json.loads(line)
-                tranisiton = json.loads(action)
-                self.words += [self.list2tensor([word['word_id'] for word in sentence])]
-                self.pos += [self.list2tensor([word['tag1_id'] for word in sentence])]
-                self.heads += [self.list2tensor([word['head'] for word in sentence])]
-                self.rels += [self.list2tensor([word['rel_id'] for word in sentence])]
-                self.actions += [self.actionsequence2tensor(tranisiton['transition'])]
-                self.relations_in_order += [self.list2tensor(tranisiton['relations'])]
-                #self.labeled_actions += [self.labeled_act2tensor(tranisiton['labeled_actions'])]
+        # Columns are memory-mapped, and only the ones used by the parsers are loaded
+        self.words, self.pos, self.heads, self.rels, self.offsets = load_columns(
+            fname, SPLIT_COLUMNS, ['words', 'tags1', 'heads', 'rels', 'offsets'])
 
-    def actionsequence2tensor(self, actions):
-        ids = [self.transition_system[act] for act in actions]
-        return torch.LongTensor(ids).to(device=constants.device)
+        # Graph-based parsers are trained without any oracle actions
+        self.actions, self.actions_offsets = None, None
+        self.relations_in_order, self.relations_offsets = None, None
+        if transition_file is not None:
+            self.actions, self.actions_offsets, self.relations_in_order, self.relations_offsets = \
+                load_columns(transition_file, ACTION_COLUMNS, ACTION_COLUMNS.keys())
 
-    def labeled_act2tensor(self,labeled_actions):
-        ret = []
-        for (act,lab) in labeled_actions:
-            act_id = torch.LongTensor(self.transition_system[act]).to(device=constants.device)
-            lab_tens = torch.LongTensor(lab).to(device=constants.device)
-            ret.append((act_id,lab_tens))
-        return ret
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
 
     @staticmethod
-    def list2tensor(data):
-        return torch.LongTensor(data).to(device=constants.device)
+    def get_slice(data, offsets, index):
+        if data is None:
+            return np.zeros(0, dtype=np.int64)
+        return data[offsets[index]:offsets[index + 1]]
 
-    @staticmethod
-    def get_n_instances(fname):
-        with open(fname, 'r') as file:
-            count = 0
-            for _ in file.readlines():
-                count += 1
-        return count
+    def __getstate__(self):
+        # Workers map the files again instead of receiving copies of the columns
+        return {'fname': self.fname, 'transition_file': self.transition_file, 'remaps': self.remaps}
+
+    def __setstate__(self, state):
+        self.__init__(state['fname'], state['transition_file'], state.get('remaps'))
 
     def __len__(self):
         return self.n_instances
 
     def __getitem__(self, index):
-        #print(self.actions[index])
-        #return (self.words[index], self.pos[index]), \
-        #       (self.heads[index], self.rels[index]), self.actions[index]
-        return (self.words[index], self.pos[index]), (self.heads[index], self.rels[index]),\
-               (self.actions[index],self.relations_in_order[index])
+        # Sentences are returned as slices of the flat columns, generate_batch pads them
+        words, pos, heads, rels = [
+            self.get_slice(data, self.offsets, index)
+            for data in [self.words, self.pos, self.heads, self.rels]]
+        actions = self.get_slice(self.actions, self.actions_offsets, index)
+        relations_in_order = self.get_slice(self.relations_in_order, self.relations_offsets, index)
+        if self.remaps is not None:
+            words_remap, tags_remap, rels_remap = self.remaps
+            words, pos, rels = words_remap[words], tags_remap[pos], rels_remap[rels]
+            relations_in_order = rels_remap[relations_in_order]
+        return (words, pos), (heads, rels), (actions, relations_in_order)
@@ -12,7 +12,8 @@ from utils import constants
 from .base import BaseParser
 from .modules import Biaffine, Bilinear, StackLSTM
 from .oracle import arc_standard_oracle
-from .word_embedding import WordEmbedding, ActionEmbedding
+from .word_embedding import WordEmbedding, ActionEmbedding, TrainVocabEmbedding, SubwordEmbedding, \
+    SUBWORD_BUCKETS
 from ..algorithm.transition_parsers import ShiftReduceParser
 from .modules import StackRNN
 
@@ -35,8 +36,10 @@ def has_head(node, arcs):
 
 class NeuralTransitionParser(BaseParser):
     def __init__(self, vocabs, embedding_size, hidden_size, arc_size, label_size, batch_size,
-                 nlayers=3, dropout=0.33, pretrained_embeddings=None, transition_system=None):
-        super().__init__()
+                 nlayers=3, dropout=0.33, pretrained_embeddings=None, transition_system=None,
+                 embedding_mode='full', word_repr='table', subword_buckets=SUBWORD_BUCKETS,
+                 pruned_words=None):
+        super().__init__(pruned_words)
         # basic parameters
         self.vocabs = vocabs
         self.embedding_size = embedding_size
@@ -46,6 +49,9 @@ class NeuralTransitionParser(BaseParser):
         self.batch_size = batch_size
         self.nlayers = nlayers
         self.dropout_prob = dropout
+        self.embedding_mode = embedding_mode
+        self.word_repr = word_repr
+        self.subword_buckets = subword_buckets
 
         # transition system
         self.transition_system = transition_system
@@ -140,11 +146,29 @@ class NeuralTransitionParser(BaseParser):
 
     def create_embeddings(self, vocabs, pretrained):
         words, tags, rels = vocabs
-        word_embeddings = WordEmbedding(words, self.embedding_size, pretrained=pretrained)
+        if self.word_repr == 'subword':
+            word_embeddings = SubwordEmbedding(words, self.embedding_size,
+                                               n_buckets=self.subword_buckets,
+                                               mode=self.embedding_mode)
+        else:
+            word_embeddings = WordEmbedding(words, self.embedding_size, pretrained=pretrained,
+                                            mode=self.embedding_mode, n_rows=self.pruned_words)
         tag_embeddings = nn.Embedding(tags.size, self.embedding_size)
         rel_embeddings = nn.Embedding(rels.size, self.embedding_size)
 
-        learned_embeddings = nn.Embedding(words.size, self.embedding_size)
+        if self.word_repr == 'subword':
+            # Hashed as well, so neither word representation grows with the vocab
+            learned_embeddings = SubwordEmbedding(words, self.embedding_size,
+                                                  n_buckets=self.subword_buckets,
+                                                  mode=self.embedding_mode)
+        elif self.embedding_mode == 'full':
+            # A WordEmbedding without pretrained vectors, so exports prune it as well
+            learned_embeddings = WordEmbedding(words, self.embedding_size, padding_idx=None,
+                                               n_rows=self.pruned_words)
+        else:
+            # Words never seen in training would keep their random vectors, they share <UNK>'s
+            learned_embeddings = TrainVocabEmbedding(words, self.embedding_size,
+                                                     oov_idx=words.SPECIAL_TOKENS.index(words.UNK))
         action_embedding = nn.Embedding(self.num_actions, 16)
         return word_embeddings, tag_embeddings, learned_embeddings, action_embedding, rel_embeddings
 
@@ -185,13 +209,18 @@ class NeuralTransitionParser(BaseParser):
         state1 = self.dropout(F.relu(self.mlp_lin2(state1)))
         #probs = nn.Softmax(dim=-1)(self.mlp_both(state1)).squeeze()
         state1 = self.dropout(F.relu(self.mlp_lin3(state1)))
-        action_probabilities = nn.Softmax(dim=-1)(self.mlp_act(state1)).squeeze(0)
+        action_logits = self.mlp_act(state1)
 
         state2 = self.dropout(F.relu(self.mlp_lin1_rel(parser_state)))
         state2 = self.dropout(F.relu(self.mlp_lin2_rel(state2)))
         # probs = nn.Softmax(dim=-1)(self.mlp_both(state1)).squeeze()
         state2 = self.dropout(F.relu(self.mlp_lin3_rel(state2)))
-        rel_probabilities = nn.Softmax(dim=-1)(self.mlp_rel(state2)).squeeze(0)
+        rel_logits = self.mlp_rel(state2)
+
+        # Under bfloat16 autocast, only the scores are bfloat16, softmaxes run in float32
+        with torch.autocast(constants.device.type, enabled=False):
+            action_probabilities = nn.Softmax(dim=-1)(action_logits.float()).squeeze(0)
+            rel_probabilities = nn.Softmax(dim=-1)(rel_logits.float()).squeeze(0)
         #print(rel_probabilities)
         return action_probabilities, rel_probabilities
 
@@ -466,7 +495,9 @@ class NeuralTransitionParser(BaseParser):
                 targets_action_batch[i, :targets_action_all_batches[i].shape[1], :] = targets_action_all_batches[
                     i].unsqueeze(2)
                 targets_rel_batch[i, :targets_rel_all_batches[i].shape[1], :] = targets_rel_all_batches[i].unsqueeze(2)
-        batch_loss = self.loss(probs_action_batch, targets_action_batch, probs_rel_batch, targets_rel_batch)
+        with torch.autocast(constants.device.type, enabled=False):
+            batch_loss = self.loss(probs_action_batch, targets_action_batch,
+                                   probs_rel_batch, targets_rel_batch)
 
         #for i in range(rels_batch.shape[0]):
         #    r = rels_batch[i]
@@ -499,8 +530,13 @@ class NeuralTransitionParser(BaseParser):
             'hidden_size': self.hidden_size,
             'arc_size': self.arc_size,
             'label_size': self.label_size,
+            'batch_size': self.batch_size,
             'nlayers': self.nlayers,
             'dropout': self.dropout_prob,
+            'transition_system': self.transition_system,
+            'embedding_mode': self.embedding_mode,
+            'word_repr': self.word_repr,
+            'subword_buckets': self.subword_buckets,
         }
 
     def check_if_good(self, built, heads, sent_lens):
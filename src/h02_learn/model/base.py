@@ -1,20 +1,27 @@
 import copy
+import inspect
 from abc import ABC, abstractmethod
+import numpy as np
 import torch
 import torch.nn as nn
 
 from utils import constants
 from utils import utils
+from .word_embedding import WordEmbedding, SideTable, get_side_fname
 
 
 class BaseParser(nn.Module, ABC):
     # pylint: disable=abstract-method
     name = 'base'
 
-    def __init__(self):
+    def __init__(self, pruned_words=None):
         super().__init__()
 
         self.best_state_dict = None#self.load_state_dict(self.state_dict())#.state_dict()
+        # Rows kept in the word embedding tables of exported models
+        self.pruned_words = pruned_words
+        # Exported models can have int8 LSTM and Linear weights
+        self.quantized = False
 
     def set_best(self):
         with torch.no_grad():
@@ -36,8 +43,38 @@ class BaseParser(nn.Module, ABC):
         torch.save({
             'kwargs': self.get_args(),
             'model_state_dict': self.state_dict(),
+            'pruned_words': self.pruned_words,
+            'quantized': self.quantized,
         }, fname)
 
+    def get_word_embeddings(self):
+        return [(name, module) for name, module in self.named_modules()
+                if isinstance(module, WordEmbedding)]
+
+    def prune_words(self, n_rows):
+        # Keeps the first n_rows rows of the word embedding tables, and
+        # returns the pruned rows of each table, by module name
+        self.pruned_words = n_rows
+        return {name: module.prune(n_rows) for name, module in self.get_word_embeddings()}
+
+    def save_side_tables(self, path, side_rows):
+        utils.mkdir(path)
+        for name, rows in side_rows.items():
+            np.save(get_side_fname(path, name), rows)
+
+    def attach_side_tables(self, path):
+        for name, module in self.get_word_embeddings():
+            module.attach_side_table(SideTable(get_side_fname(path, name), self.pruned_words))
+
+    def quantize(self):
+        # Dynamic quantization stores LSTM and Linear weights as int8, and
+        # quantizes their inputs on the fly. Quantized kernels only run on the CPU.
+        self.cpu()
+        torch.quantization.quantize_dynamic(self, {nn.LSTM, nn.Linear}, dtype=torch.qint8,
+                                            inplace=True)
+        self.quantized = True
+        return self
+
     @abstractmethod
     def get_args(self):
         pass
@@ -45,7 +82,16 @@ class BaseParser(nn.Module, ABC):
     @classmethod
     def load(cls, path):
         checkpoints = cls.load_checkpoint(path)
-        model = cls(**checkpoints['kwargs'])
+        kwargs = checkpoints['kwargs']
+        # Exported models only keep the first word embedding rows, others are read from side tables
+        if checkpoints.get('pruned_words') is not None:
+            kwargs = dict(kwargs, pruned_words=checkpoints['pruned_words'])
+        model = cls(**kwargs)
+        if model.pruned_words is not None:
+            model.attach_side_tables(path)
+        # Quantized layers have their own state dicts, so they are replaced before loading
+        if checkpoints.get('quantized'):
+            model.quantize()
         model.load_state_dict(checkpoints['model_state_dict'])
         del checkpoints
         return model
@@ -53,7 +99,11 @@ class BaseParser(nn.Module, ABC):
     @classmethod
     def load_checkpoint(cls, path):
         fname = cls.get_name(path)
-        return torch.load(fname, map_location=constants.device)
+        # Checkpoints pickle the vocabs, newer torch versions only unpickle tensors by default
+        kwargs = {}
+        if 'weights_only' in inspect.signature(torch.load).parameters:
+            kwargs['weights_only'] = False
+        return torch.load(fname, map_location=constants.device, **kwargs)
 
     @classmethod
     def get_name(cls, path):
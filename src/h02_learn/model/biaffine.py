@@ -6,14 +6,15 @@ import torch.nn.functional as F
 from utils import constants
 from .base import BaseParser
 from .modules import Biaffine, Bilinear
-from .word_embedding import WordEmbedding
+from .word_embedding import WordEmbedding, SubwordEmbedding, SUBWORD_BUCKETS
 
 
 class BiaffineParser(BaseParser):
     # pylint: disable=arguments-differ,too-many-instance-attributes,too-many-arguments
     def __init__(self, vocabs, embedding_size, hidden_size, arc_size, label_size,
-                 nlayers=3, dropout=0.33, pretrained_embeddings=None):
-        super().__init__()
+                 nlayers=3, dropout=0.33, pretrained_embeddings=None, embedding_mode='full',
+                 word_repr='table', subword_buckets=SUBWORD_BUCKETS, pruned_words=None):
+        super().__init__(pruned_words)
 
         self.vocabs = vocabs
         self.embedding_size = embedding_size
@@ -22,6 +23,9 @@ class BiaffineParser(BaseParser):
         self.label_size = label_size
         self.nlayers = nlayers
         self.dropout_p = dropout
+        self.embedding_mode = embedding_mode
+        self.word_repr = word_repr
+        self.subword_buckets = subword_buckets
 
         self.words_embedding, self.tags_embedding = \
             self.create_embeddings(vocabs, pretrained=pretrained_embeddings)
@@ -31,18 +35,35 @@ class BiaffineParser(BaseParser):
             batch_first=True, bidirectional=True)
         self.dropout = nn.Dropout(dropout)
 
-        self.linear_arc_dep = nn.Linear(hidden_size * 2, arc_size)
-        self.linear_arc_head = nn.Linear(hidden_size * 2, arc_size)
+        # Arc dependent, arc head, label dependent and label head projections, in one matmul
+        self.linear_proj = nn.Linear(hidden_size * 2, arc_size * 2 + label_size * 2)
         self.biaffine = Biaffine(arc_size, arc_size)
 
         _, _, rels = vocabs
-        self.linear_label_dep = nn.Linear(hidden_size * 2, label_size)
-        self.linear_label_head = nn.Linear(hidden_size * 2, label_size)
         self.bilinear_label = Bilinear(label_size, label_size, rels.size)
 
+        self._register_load_state_dict_pre_hook(self.fuse_projections)
+
+    @staticmethod
+    def fuse_projections(state_dict, prefix, *args):
+        # pylint: disable=unused-argument
+        # Checkpoints saved before the projections were fused have four linear layers
+        names = ['linear_arc_dep', 'linear_arc_head', 'linear_label_dep', 'linear_label_head']
+        for param in ['weight', 'bias']:
+            keys = ['%s%s.%s' % (prefix, name, param) for name in names]
+            if all(key in state_dict for key in keys):
+                state_dict['%slinear_proj.%s' % (prefix, param)] = torch.cat(
+                    [state_dict.pop(key) for key in keys], dim=0)
+
     def create_embeddings(self, vocabs, pretrained=None):
         words, tags, _ = vocabs
-        words_embedding = WordEmbedding(words, self.embedding_size, pretrained=pretrained)
+        if self.word_repr == 'subword':
+            words_embedding = SubwordEmbedding(words, self.embedding_size,
+                                               n_buckets=self.subword_buckets,
+                                               mode=self.embedding_mode)
+        else:
+            words_embedding = WordEmbedding(words, self.embedding_size, pretrained=pretrained,
+                                            mode=self.embedding_mode, n_rows=self.pruned_words)
         tags_embedding = nn.Embedding(tags.size, self.embedding_size)
         return words_embedding, tags_embedding
 
@@ -51,12 +72,13 @@ class BiaffineParser(BaseParser):
 
         sent_lens = (x[0] != 0).sum(-1)
         h_t = self.run_lstm(x_emb, sent_lens)
-        h_logits = self.get_head_logits(h_t, sent_lens)
+        arc_dep, arc_head, label_dep, label_head = self.project(h_t)
+        h_logits = self.get_head_logits(arc_dep, arc_head, sent_lens)
 
         if head is None:
             head = h_logits.argmax(-1)
 
-        l_logits = self.get_label_logits(h_t, head)
+        l_logits = self.get_label_logits(label_dep, label_head, head)
 
         return h_logits, l_logits
 
@@ -79,23 +101,15 @@ class BiaffineParser(BaseParser):
 
         return h_t
 
-    def get_head_logits(self, h_t, sent_lens):
-        h_dep = self.dropout(F.relu(self.linear_arc_dep(h_t)))
-        h_arc = self.dropout(F.relu(self.linear_arc_head(h_t)))
-
-        h_logits = self.biaffine(h_arc, h_dep)
-
-        # Zero logits for items after sentence length
-        for i, sent_len in enumerate(sent_lens):
-            h_logits[i, sent_len:, :] = 0
-            h_logits[i, :, sent_len:] = 0
-
-        return h_logits
+    def project(self, h_t):
+        proj = self.dropout(F.relu(self.linear_proj(h_t)))
+        return proj.split([self.arc_size, self.arc_size, self.label_size, self.label_size], dim=-1)
 
-    def get_label_logits(self, h_t, head):
-        l_dep = self.dropout(F.relu(self.linear_label_dep(h_t)))
-        l_head = self.dropout(F.relu(self.linear_label_head(h_t)))
+    def get_head_logits(self, h_dep, h_arc, sent_lens):
+        # Logits of items after sentence length are zeroed
+        return self.biaffine(h_arc, h_dep, sent_lens)
 
+    def get_label_logits(self, l_dep, l_head, head):
         if self.training:
             assert head is not None, 'During training head should not be None'
 
@@ -112,4 +126,7 @@ class BiaffineParser(BaseParser):
             'label_size': self.label_size,
             'nlayers': self.nlayers,
             'dropout': self.dropout_p,
+            'embedding_mode': self.embedding_mode,
+            'word_repr': self.word_repr,
+            'subword_buckets': self.subword_buckets,
         }
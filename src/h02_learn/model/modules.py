@@ -142,13 +142,20 @@ class Biaffine(nn.Module):
         nn.init.constant_(self.bias, 0.)
         nn.init.xavier_uniform_(self.matrix)
 
-    def forward(self, x_l, x_r):
+    def forward(self, x_l, x_r, lengths=None):
         # x shape [batch, length_l, length_r]
         x = torch.matmul(x_l, self.matrix)
         x = torch.bmm(x, x_r.transpose(1, 2)) + self.bias
 
         # x shape [batch, length_l, 1] and [batch, 1, length_r]
         x += self.linear_l(x_l) + self.linear_r(x_r).transpose(1, 2)
+
+        if lengths is not None:
+            # Zero scores of padded rows and columns
+            lengths = lengths.to(x.device).unsqueeze(-1)
+            mask_l = torch.arange(x.shape[1], device=x.device) < lengths
+            mask_r = torch.arange(x.shape[2], device=x.device) < lengths
+            x.masked_fill_(~(mask_l.unsqueeze(2) & mask_r.unsqueeze(1)), 0)
         return x
 
 
@@ -165,6 +172,8 @@ class Bilinear(nn.Module):
         self.linear_r = nn.Linear(dim_right, dim_out)
 
     def forward(self, x_l, x_r):
+        # Bilinear has no autocast rule, so bfloat16 inputs are cast back to the weight dtype
+        x_l, x_r = x_l.to(self.bilinear.weight.dtype), x_r.to(self.bilinear.weight.dtype)
         # x shape [batch, length, dim_out]
         x = self.bilinear(x_l, x_r)
 
@@ -1,16 +1,84 @@
+from collections import OrderedDict
 import numpy as np
 import torch
 import torch.nn as nn
 from utils import constants
 
+# full: one trainable table over the whole vocab, with dense gradients
+# sparse: the same table, with sparse gradients
+# frozen-delta: the pretrained table is frozen, and a trainable table with
+#   sparse gradients adds a delta to the words seen in training only
+EMBEDDING_MODES = ['full', 'sparse', 'frozen-delta']
+# Rows kept in memory by each side table
+SIDE_CACHE_ROWS = 10000
+# table: one vector per vocab type, subword: hashed character n-grams
+WORD_REPRS = ['table', 'subword']
+SUBWORD_BUCKETS = 2 ** 18
 
-class WordEmbedding(nn.Module):
+
+def get_side_fname(path, name):
+    return '%s/%s.side.npy' % (path, name)
+
+
+class SideTable:
+    # Read-only memory-mapped rows of the words pruned from an embedding table,
+    # row i holding word offset + i. Rows are read as they are looked up, and
+    # the last cache_size of them are kept in memory.
+    def __init__(self, fname, offset, cache_size=SIDE_CACHE_ROWS):
+        self.rows = np.load(fname, mmap_mode='r')
+        self.offset = offset
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def get_row(self, idx):
+        row = self.cache.pop(idx, None)
+        if row is None:
+            row = torch.from_numpy(np.array(self.rows[idx - self.offset]))
+        self.cache[idx] = row
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return row
+
+    def lookup(self, ids):
+        unique, inverse = torch.unique(ids, return_inverse=True)
+        rows = torch.stack([self.get_row(idx) for idx in unique.tolist()])
+        return rows.to(ids.device)[inverse]
+
+
+class TrainVocabEmbedding(nn.Module):
     # pylint: disable=arguments-differ
-    def __init__(self, vocab, embedding_size, pretrained=None):
+    # Table with sparse gradients over the special tokens and the words seen
+    # in training, which come first in the vocab. Other words use row oov_idx.
+    def __init__(self, vocab, embedding_size, oov_idx, padding_idx=None):
+        super().__init__()
+        self.train_size = vocab.train_size
+        self.oov_idx = oov_idx
+        self.embedding = nn.Embedding(self.train_size, embedding_size, padding_idx=padding_idx,
+                                      sparse=True)
+
+    def forward(self, x):
+        return self.embedding(x.masked_fill(x >= self.train_size, self.oov_idx))
+
+
+class WordEmbedding(nn.Module):
+    # pylint: disable=arguments-differ,too-many-instance-attributes
+    def __init__(self, vocab, embedding_size, pretrained=None, mode='full', padding_idx=0,
+                 n_rows=None):
+        # pylint: disable=too-many-arguments
         super().__init__()
         self.vocab = vocab
         self.vocab_size = vocab.size
         self.embedding_size = embedding_size
+        self.mode = mode
+        self.padding_idx = padding_idx
+
+        self.delta = None
+        # Set on pruned tables, see prune
+        self.side_table = None
+        if n_rows is not None:
+            # Exported models are loaded into tables built pruned
+            self.embedding = self.get_pruned_table(torch.zeros(n_rows, embedding_size))
+            return
 
         if pretrained is not None:
             pretrained_tensor = self.dict2tensor(self.vocab_size, embedding_size, pretrained)
@@ -18,31 +86,118 @@ class WordEmbedding(nn.Module):
             pretrained_tensor = None
 
         self.embedding = nn.Embedding(self.vocab_size, self.embedding_size,
-                                      _weight=pretrained_tensor, padding_idx=0)
-        self.embedding.weight.requires_grad = True
+                                      _weight=pretrained_tensor, padding_idx=padding_idx,
+                                      sparse=(mode == 'sparse'))
+        self.embedding.weight.requires_grad = mode != 'frozen-delta'
+
+        if mode == 'frozen-delta':
+            # Words not seen in training map to the padding row, which stays zero
+            self.delta = TrainVocabEmbedding(vocab, embedding_size, oov_idx=0, padding_idx=0)
+            nn.init.zeros_(self.delta.embedding.weight)
 
-    def dict2tensor(self, vocab_size, embedding_size, pretrained_dict):
+    def dict2tensor(self, vocab_size, embedding_size, pretrained):
         scale = np.sqrt(3.0 / embedding_size)
-        pretrained = np.empty([vocab_size, embedding_size], dtype=np.float32)
-        pretrained[:3, :] = np.random.uniform(
-            - scale, scale, [3, embedding_size]).astype(np.float32)  # Special symbols
-
-        oov = 0
-        for word, index in self.vocab.items():
-            if word in pretrained_dict:
-                embedding = pretrained_dict[word]
-            elif word.lower() in pretrained_dict:
-                embedding = pretrained_dict[word.lower()]
-            else:
-                embedding = np.random.uniform(-scale, scale, [1, embedding_size]).astype(np.float32)
-                oov += 1
-            pretrained[index, :] = embedding
-
-        print('# OOV words: %d' % oov)
+        aligned, oov = pretrained.get_aligned(self.vocab)
+        assert aligned.shape == (vocab_size, embedding_size), \
+            'Pretrained embeddings should match the vocabulary and embedding size'
+
+        # Special symbols and OOV words are initialised randomly on every run
+        pretrained = np.array(aligned, dtype=np.float32)
+        pretrained[oov] = np.random.uniform(
+            - scale, scale, [len(oov), embedding_size]).astype(np.float32)
+
+        print('# OOV words: %d' % len(oov))
         return torch.from_numpy(pretrained)
 
+    def lookup(self, x):
+        if self.delta is None:
+            return self.embedding(x)
+        return self.embedding(x) + self.delta(x)
+
+    def prune(self, n_rows):
+        # Keeps the first n_rows rows, with any delta added to them, and returns the
+        # other rows as an array. They are looked up from a side table afterwards.
+        with torch.no_grad():
+            weight = self.embedding.weight.detach().clone()
+            if self.delta is not None:
+                weight[:self.delta.train_size] += self.delta.embedding.weight
+        self.delta = None
+        self.embedding = self.get_pruned_table(weight[:n_rows].clone())
+        return weight[n_rows:].cpu().numpy()
+
+    def get_pruned_table(self, weight):
+        embedding = nn.Embedding(weight.shape[0], self.embedding_size, _weight=weight,
+                                 padding_idx=self.padding_idx)
+        embedding.weight.requires_grad = False
+        return embedding
+
+    def attach_side_table(self, side_table):
+        self.side_table = side_table
+
     def forward(self, x):
-        return self.embedding(x)
+        if self.side_table is None:
+            return self.lookup(x)
+
+        pruned = x >= self.embedding.num_embeddings
+        emb = self.lookup(x.masked_fill(pruned, 0))
+        if pruned.any():
+            emb[pruned] = self.side_table.lookup(x[pruned]).to(emb.dtype)
+        return emb
+
+
+def fnv1a(data):
+    # 32 bit FNV-1a hash of a bytes string, which is the same on every run
+    value = 2166136261
+    for byte in data:
+        value = ((value ^ byte) * 16777619) & 0xffffffff
+    return value
+
+
+class SubwordEmbedding(nn.Module):
+    # pylint: disable=arguments-differ,too-many-instance-attributes
+    # Represents each word by the mean of the vectors of its character n-grams,
+    # hashed into n_buckets rows, so its size does not grow with the vocab.
+    # Special tokens get rows of their own. Each batch builds the vectors of
+    # its unique types once, and the buckets of each type are cached.
+    def __init__(self, vocab, embedding_size, n_buckets=SUBWORD_BUCKETS, min_n=3, max_n=6,
+                 mode='full'):
+        # pylint: disable=too-many-arguments
+        super().__init__()
+        self.vocab = vocab
+        self.embedding_size = embedding_size
+        self.n_buckets = n_buckets
+        self.min_n = min_n
+        self.max_n = max_n
+        self.n_special = len(vocab.SPECIAL_TOKENS)
+        self.embedding = nn.EmbeddingBag(n_buckets + self.n_special, embedding_size, mode='mean',
+                                         sparse=(mode != 'full'))
+        self.cache = {}
+
+    def hash_ngrams(self, idx):
+        if idx < self.n_special:
+            return np.array([self.n_buckets + idx], dtype=np.int64)
+
+        # The whole word is used as well, with its boundaries marked
+        word = '<%s>' % self.vocab.types[idx]
+        ngrams = set([word])
+        for size in range(self.min_n, self.max_n + 1):
+            ngrams.update(word[i:i + size] for i in range(len(word) - size + 1))
+        return np.array(sorted(fnv1a(ngram.encode('utf-8')) % self.n_buckets for ngram in ngrams),
+                        dtype=np.int64)
+
+    def get_buckets(self, idx):
+        buckets = self.cache.get(idx)
+        if buckets is None:
+            buckets = self.cache[idx] = self.hash_ngrams(idx)
+        return buckets
+
+    def forward(self, x):
+        types, inverse = torch.unique(x, return_inverse=True)
+        buckets = [self.get_buckets(idx) for idx in types.tolist()]
+        offsets = np.cumsum([0] + [len(row) for row in buckets[:-1]])
+        vectors = self.embedding(torch.from_numpy(np.concatenate(buckets)).to(x.device),
+                                 torch.from_numpy(offsets).to(x.device))
+        return vectors[inverse]
 
 
 class ActionEmbedding(nn.Module):
@@ -1,26 +1,53 @@
 import sys
+import time
 import argparse
+import contextlib
+import numpy as np
 import torch
+import torch.nn as nn
 import torch.optim as optim
 
 sys.path.append('./src/')
-from h02_learn.dataset import get_data_loaders
+from h02_learn.dataset import get_data_loaders, get_sample_loader, get_full_loader, \
+    PrecollatedLoader
+from h02_learn.dataset.multi import MultiSyntaxDataset
+from h02_learn.dataset.sampler import BATCH_COSTS
 from h02_learn.model import BiaffineParser, MSTParser, ArcStandardStackLSTM, \
     ArcEagerStackLSTM, HybridStackLSTM, NonProjectiveStackLSTM
 from h02_learn.model import NeuralTransitionParser
+from h02_learn.model.word_embedding import EMBEDDING_MODES, WORD_REPRS, SUBWORD_BUCKETS
 from h02_learn.train_info import TrainInfo
 from h02_learn.algorithm.mst import get_mst_batch
 from utils import constants
 from utils import utils
 
+# Normal quantile of the 95% confidence intervals of sampled evaluations
+CONFIDENCE_Z = 1.96
+PRECISIONS = ['fp32', 'bf16']
+
 
 def get_args():
     parser = argparse.ArgumentParser()
     # Data
-    parser.add_argument('--language', type=str, required=True)
+    # Several languages or treebanks are trained together, with merged vocabs
+    parser.add_argument('--language', type=str, nargs='+', required=True)
     parser.add_argument('--data-path', type=str, default='data/')
     parser.add_argument('--batch-size', type=int, default=32)
     parser.add_argument('--batch-size-eval', type=int, default=128)
+    # Token budgets replace --batch-size: tokens per optimizer step, and the most
+    # that fits in one forward pass. Larger steps accumulate gradients.
+    parser.add_argument('--batch-tokens', type=int, default=None)
+    parser.add_argument('--max-batch-tokens', type=int, default=None)
+    parser.add_argument('--batch-cost', choices=BATCH_COSTS, default='tokens')
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--pin-memory', action='store_true')
+    # Run model forward passes under bfloat16 autocast, losses and MST decoding stay in float32
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32')
+    # Stream the training set from disk, shuffling it through a bounded buffer
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--shuffle-buffer', type=int, default=100000)
+    # Treebanks are drawn with probability proportional to size ** (1 / temperature)
+    parser.add_argument('--temperature', type=float, default=1.)
     # Model
     parser.add_argument('--nlayers', type=int, default=3)
     parser.add_argument('--embedding-size', type=int, default=100)
@@ -28,14 +55,29 @@ def get_args():
     parser.add_argument('--arc-size', type=int, default=500)
     parser.add_argument('--label-size', type=int, default=100)
     parser.add_argument('--dropout', type=float, default=.33)
+    # Word embedding tables with sparse gradients, or a frozen pretrained table
+    # plus a small trainable delta over the training vocab
+    parser.add_argument('--embedding-mode', choices=EMBEDDING_MODES, default='full')
+    # Represent words by hashed character n-grams instead of one vector per vocab
+    # type, with --subword-buckets rows whatever the size of the vocab
+    parser.add_argument('--word-repr', choices=WORD_REPRS, default='table')
+    parser.add_argument('--subword-buckets', type=int, default=SUBWORD_BUCKETS)
     parser.add_argument('--model', choices=['biaffine', 'mst', 'arc-standard',
                                             'arc-eager', 'hybrid', 'non-projective'],
                         default='arc-standard')
     # Optimization
     parser.add_argument('--optim', choices=['adam', 'adamw', 'sgd'], default='adam')
     parser.add_argument('--eval-batches', type=int, default=20)
+    # Periodic evaluations use a fixed random sample of this many dev sentences,
+    # and only run on the full dev set when the sample could be a new best
+    parser.add_argument('--eval-sample', type=int, default=None)
+    # The final training set evaluation takes as long as an epoch, it can run on
+    # a sample as large as the dev set instead, or be skipped
+    parser.add_argument('--final-train-eval', choices=['full', 'sampled', 'none'], default='full')
     parser.add_argument('--wait-epochs', type=int, default=10)
     parser.add_argument('--lr-decay', type=float, default=.5)
+    # Stop after this many optimizer steps, however many epochs they take
+    parser.add_argument('--max-steps', type=int, default=None)
     # Save
     parser.add_argument('--checkpoints-path', type=str, default='checkpoints/')
     parser.add_argument('--seed', type=int, default=7)
@@ -43,40 +85,75 @@ def get_args():
 
     args = parser.parse_args()
     args.wait_iterations = args.wait_epochs * args.eval_batches
-    args.save_path = '%s/%s/%s/%s/' % (args.checkpoints_path, args.language, args.model, args.batch_size)
+    args.batch_tokens_train, args.batch_tokens_eval, args.accumulate = get_token_budgets(
+        args.batch_tokens, args.max_batch_tokens)
+    args.save_path = '%s/%s/%s/%s/' % (
+        args.checkpoints_path, '+'.join(args.language), args.model, args.batch_size)
     utils.config(args.seed)
     return args
 
 
-def get_optimizer(paramters, optim_alg, lr_decay):
+def get_token_budgets(batch_tokens, max_batch_tokens):
+    # Splits each optimizer step into as few forward passes as fit in max_batch_tokens
+    if batch_tokens is None and max_batch_tokens is None:
+        return None, None, 1
+
+    batch_tokens = batch_tokens or max_batch_tokens
+    max_batch_tokens = max_batch_tokens or batch_tokens
+    accumulate = -(-batch_tokens // max_batch_tokens)
+    return batch_tokens // accumulate, max_batch_tokens, accumulate
+
+
+def get_sparse_parameters(model):
+    return [module.weight for module in model.modules()
+            if isinstance(module, (nn.Embedding, nn.EmbeddingBag))
+            and module.sparse and module.weight.requires_grad]
+
+
+def get_optimizer(model, optim_alg, lr_decay):
+    # Returns a list of optimizers, with their lr schedulers. Adam variants can
+    # not take sparse gradients, embedding tables that produce them get a
+    # SparseAdam of their own, which only keeps state for the rows it updates.
+    sparse = get_sparse_parameters(model) if optim_alg != 'sgd' else []
+    sparse_ids = set(id(param) for param in sparse)
+    paramters = [param for param in model.parameters()
+                 if param.requires_grad and id(param) not in sparse_ids]
+
     if optim_alg == "adamw":
-        optimizer = optim.AdamW(paramters, betas=(.9, .9))
+        optimizers = [optim.AdamW(paramters, betas=(.9, .9))]
     elif optim_alg == "adam":
-        optimizer = optim.Adam(paramters, betas=(.9, .9))
+        optimizers = [optim.Adam(paramters, betas=(.9, .9))]
     else:
-        optimizer = optim.SGD(paramters, lr=0.01)
+        optimizers = [optim.SGD(paramters, lr=0.01)]
+    if sparse:
+        optimizers += [optim.SparseAdam(sparse, betas=(.9, .9))]
 
-    lr_scheduler = optim.lr_scheduler.ExponentialLR(optimizer, lr_decay)
-    return optimizer, lr_scheduler
+    lr_schedulers = [optim.lr_scheduler.ExponentialLR(optimizer, lr_decay)
+                     for optimizer in optimizers]
+    return optimizers, lr_schedulers
 
 
 def get_model(vocabs, embeddings, args):
     if args.model == 'mst':
         return MSTParser(
             vocabs, args.embedding_size, args.hidden_size, args.arc_size, args.label_size,
-            nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings) \
+            nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings,
+            embedding_mode=args.embedding_mode,
+            word_repr=args.word_repr, subword_buckets=args.subword_buckets) \
             .to(device=constants.device)
     if args.model == 'arc-standard':
         return NeuralTransitionParser(
             vocabs, args.embedding_size, args.hidden_size, args.arc_size, args.label_size, args.batch_size,
             nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings,
-            transition_system=constants.arc_standard) \
+            transition_system=constants.arc_standard, embedding_mode=args.embedding_mode,
+            word_repr=args.word_repr, subword_buckets=args.subword_buckets) \
             .to(device=constants.device)
     elif args.model == 'arc-eager':
         return NeuralTransitionParser(
             vocabs, args.embedding_size, args.hidden_size, args.arc_size, args.label_size, args.batch_size,
             nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings,
-            transition_system=constants.arc_eager) \
+            transition_system=constants.arc_eager, embedding_mode=args.embedding_mode,
+            word_repr=args.word_repr, subword_buckets=args.subword_buckets) \
             .to(device=constants.device)
     elif args.model == 'hybrid':
         return HybridStackLSTM(
@@ -91,7 +168,9 @@ def get_model(vocabs, embeddings, args):
     else:
         return BiaffineParser(
             vocabs, args.embedding_size, args.hidden_size, args.arc_size, args.label_size,
-            nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings) \
+            nlayers=args.nlayers, dropout=args.dropout, pretrained_embeddings=embeddings,
+            embedding_mode=args.embedding_mode,
+            word_repr=args.word_repr, subword_buckets=args.subword_buckets) \
             .to(device=constants.device)
 
 
@@ -117,6 +196,27 @@ def calculate_attachment_score(heads_tgt, heads, predicted_rels, rels):
     return las, uas
 
 
+def sentence_attachment_scores(heads_tgt, heads, predicted_rels, rels):
+    # Labelled and unlabelled correct attachments, and scored tokens, of each sentence
+    mask = heads != -1
+    acc_h = (heads_tgt == heads) & mask
+    acc_l = acc_h & (predicted_rels == rels)
+    return torch.stack([acc_l.sum(-1), acc_h.sum(-1), mask.sum(-1)], dim=-1)
+
+
+def get_confidence_interval(correct, tokens, population):
+    # Half width of the 95% interval of the attachment score of a population of
+    # sentences, estimated from a sample of them drawn without replacement
+    n_sentences = len(tokens)
+    if n_sentences < 2:
+        return float('inf')
+    score = correct.sum() / tokens.sum()
+    residuals = correct - score * tokens
+    variance = (1 - n_sentences / population) * residuals.var(ddof=1) / \
+        (n_sentences * tokens.mean() ** 2)
+    return CONFIDENCE_Z * np.sqrt(variance)
+
+
 def simple_attachment_scores(predicted_heads, heads, lengths):
     correct = torch.eq(predicted_heads[:, lengths], heads[:, lengths]).sum().item()
     total = torch.sum(lengths).item()
@@ -124,110 +224,250 @@ def simple_attachment_scores(predicted_heads, heads, lengths):
     return correct / total
 
 
-def _evaluate(evalloader, model):
+def autocast(precision):
+    # Matmuls and LSTMs run in bfloat16 under bf16. Models run their softmaxes and losses
+    # outside of it, on float32 scores.
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(constants.device.type, dtype=torch.bfloat16)
+
+
+def run_model(model, text, pos, heads, rels, transitions, relations_in_order, mode,
+              precision='fp32'):
+    # pylint: disable=too-many-arguments
+    # Graph-based parsers score all arcs at once and need no oracle actions
+    if isinstance(model, BiaffineParser):
+        # Padded heads are -1, their labels are ignored by the loss
+        with autocast(precision):
+            h_logits, l_logits = model((text, pos), heads.clamp(min=0) if mode == 'train' else None)
+        # Log-softmaxes, the MST loss determinant and MST decoding are sensitive,
+        # they get float32 inputs
+        h_logits, l_logits = h_logits.float(), l_logits.float()
+        loss = model.loss(h_logits, l_logits, heads, rels)
+        if mode == 'train':
+            return loss, None, None
+
+        lengths = (text != 0).sum(-1)
+        predicted_heads = get_mst_batch(h_logits, lengths)
+        predicted_rels = l_logits.argmax(-1)
+        return loss, predicted_heads, predicted_rels
+
+    # Transition parsers compute their softmaxes and loss in float32 themselves
+    with autocast(precision):
+        return model((text, pos), transitions, relations_in_order, mode=mode)
+
+
+def _evaluate(evalloader, model, precision='fp32'):
     # pylint: disable=too-many-locals
     dev_loss, dev_las, dev_uas, n_instances = 0, 0, 0, 0
-    steps = 0
+    steps, scores = 0, []
     for (text, pos), (heads, rels), (transitions, relations_in_order) in evalloader:
         steps += 1
 
-        loss, predicted_heads, predicted_rels = model((text, pos), transitions, relations_in_order, mode='eval')
-        # loss = model.loss(h_logits, l_logits, heads, rels)
-        lengths = (text != 0).sum(-1)
-        # heads_tgt = get_mst_batch(h_logits, lengths)
+        loss, predicted_heads, predicted_rels = run_model(
+            model, text, pos, heads, rels, transitions, relations_in_order, mode='eval',
+            precision=precision)
         las, uas = calculate_attachment_score(predicted_heads, heads, predicted_rels, rels)
         batch_size = text.shape[0]
         dev_loss += (loss * batch_size)
         dev_las += (las * batch_size)
         dev_uas += (uas * batch_size)
         n_instances += batch_size
+        scores += [sentence_attachment_scores(predicted_heads, heads, predicted_rels, rels).cpu()]
 
-    return dev_loss / n_instances, dev_las / n_instances, dev_uas / n_instances
+    results = (dev_loss / n_instances, dev_las / n_instances, dev_uas / n_instances)
+    return results, torch.cat(scores).numpy()
 
 
-def evaluate(evalloader, model):
+def evaluate_with_scores(evalloader, model, precision='fp32'):
     model.eval()
     with torch.no_grad():
-        result = _evaluate(evalloader, model)
+        result = _evaluate(evalloader, model, precision)
     model.train()
     return result
 
 
-def train_batch(text, pos, heads, rels, transitions, relations_in_order, model, optimizer):
-    optimizer.zero_grad()
+def evaluate(evalloader, model, precision='fp32'):
+    result, _ = evaluate_with_scores(evalloader, model, precision)
+    return result
+
+
+def compare_precision(evalloader, model, precision):
+    # Evaluation throughput and scores under precision, next to the float32 ones
+    for eval_precision in ['fp32', precision]:
+        start = time.time()
+        _, las, uas = evaluate(evalloader, model, eval_precision)
+        elapsed = time.time() - start
+        print('%s: %.1f sentences/s las: %.4f uas: %.4f' %
+              (eval_precision, len(evalloader.dataset) / elapsed, las, uas))
+
+
+def get_treebank_scores(evalloader, scores):
+    # LAS and UAS of each treebank, when several are evaluated together
+    dataset = evalloader.dataset
+    if not isinstance(dataset, MultiSyntaxDataset):
+        return None
+
+    # Unshuffled loaders always give their sentences in the same order
+    treebanks = dataset.treebanks[np.concatenate(list(evalloader.batch_sampler))]
+    results = {}
+    for treebank, name in enumerate(dataset.names):
+        correct_l, correct_h, tokens = scores[treebanks == treebank].sum(0)
+        results[name] = (correct_l / max(tokens, 1), correct_h / max(tokens, 1))
+    return results
+
+
+def evaluate_sample(sampleloader, model, population, precision='fp32'):
+    # Scores of a sample of a population of sentences, with their confidence intervals
+    (loss, _, _), scores = evaluate_with_scores(sampleloader, model, precision)
+    correct_l, correct_h, tokens = scores.T.astype(np.float64)
+    results = (loss, correct_l.sum() / tokens.sum(), correct_h.sum() / tokens.sum())
+    intervals = (get_confidence_interval(correct_l, tokens, population),
+                 get_confidence_interval(correct_h, tokens, population))
+    return results, intervals
+
+
+def evaluate_dev(devloader, devsample, model, train_info, precision='fp32'):
+    # Evaluates on the full dev set only when the dev sample could be a new best.
+    # Returns the dev scores, their intervals if sampled, and the full scores of each treebank.
+    if devsample is not None:
+        results, intervals = evaluate_sample(devsample, model, len(devloader.dataset), precision)
+        if not train_info.might_be_best(results[1], intervals[0]):
+            return results, intervals, None
+
+    results, scores = evaluate_with_scores(devloader, model, precision)
+    return results, None, get_treebank_scores(devloader, scores)
 
-    text, pos = text.to(device=constants.device), pos.to(device=constants.device)
-    # heads, rels = heads.to(device=constants.device), rels.to(device=constants.device)
-    transitions = transitions.to(device=constants.device)
-    relations_in_order = relations_in_order.to(device=constants.device)
 
-    loss, pred_h, pred_rel = model((text, pos), transitions, relations_in_order, mode='train')
+def train_batch(batches, model, optimizers, precision='fp32'):
+    # Gradients of all batches are accumulated into a single optimizer step
+    for optimizer in optimizers:
+        optimizer.zero_grad()
 
-    loss.backward(retain_graph=True)
-    optimizer.step()
+    total_loss = 0
+    for (text, pos), (heads, rels), (transitions, relations_in_order) in batches:
+        loss, _, _ = run_model(model, text, pos, heads, rels, transitions, relations_in_order,
+                               mode='train', precision=precision)
+        loss = loss / len(batches)
 
-    return loss.item()
+        loss.backward(retain_graph=True)
+        total_loss += loss.item()
+
+    for optimizer in optimizers:
+        optimizer.step()
+
+    return total_loss
 
 
 def train(trainloader, devloader, model, eval_batches, wait_iterations, optim_alg, lr_decay,
-          save_path, save_batch=False):
+          save_path, save_batch=False, accumulate=1, max_steps=None, devsample=None,
+          precision='fp32'):
     # pylint: disable=too-many-locals,too-many-arguments
-    optimizer, lr_scheduler = get_optimizer(model.parameters(), optim_alg, lr_decay)
-    train_info = TrainInfo(wait_iterations, eval_batches)
+    optimizers, lr_schedulers = get_optimizer(model, optim_alg, lr_decay)
+    train_info = TrainInfo(wait_iterations, eval_batches, max_steps)
     while not train_info.finish:
         steps = 0
 
-        for (text, pos), (heads, rels), (transitions, relations_in_order) in trainloader:
+        for batches in utils.get_chunks(trainloader, accumulate):
 
             steps += 1
-            loss = train_batch(text, pos, heads, rels, transitions, relations_in_order, model, optimizer)
+            loss = train_batch(batches, model, optimizers, precision)
             #print("train loss in step {} is {}".format(steps,loss))
             train_info.new_batch(loss)
             if train_info.eval:
-                dev_results = evaluate(devloader, model)
+                dev_results, intervals, treebank_results = evaluate_dev(
+                    devloader, devsample, model, train_info, precision)
 
-                if train_info.is_best(dev_results):
+                if train_info.is_best(dev_results, treebank_results):
                     model.set_best()
                     if save_batch:
                         model.save(save_path)
                 elif train_info.reduce_lr:
-                    lr_scheduler.step()
-                    optimizer.state.clear()
+                    for optimizer, lr_scheduler in zip(optimizers, lr_schedulers):
+                        lr_scheduler.step()
+                        optimizer.state.clear()
                     model.recover_best()
                     print('\tReduced lr')
                 elif train_info.finish:
-                    train_info.print_progress(dev_results)
+                    train_info.print_progress(dev_results, intervals, treebank_results)
                     break
-                train_info.print_progress(dev_results)
+                train_info.print_progress(dev_results, intervals, treebank_results)
+            if train_info.out_of_steps:
+                break
 
     model.recover_best()
 
 
+def get_indexed_dataset(loader, stream):
+    # The streamed loader wraps the indexed dataset
+    return loader.dataset.dataset if stream else loader.dataset
+
+
+def evaluate_train(trainloader, n_sentences, model, args, random_state):
+    if args.final_train_eval == 'none':
+        return float('nan'), float('nan'), float('nan')
+    dataset = get_indexed_dataset(trainloader, args.stream)
+    if args.final_train_eval == 'full':
+        # Training batches are drawn at random from several treebanks, so the
+        # training set is evaluated in order instead
+        fullloader = get_full_loader(dataset, args.batch_size_eval, args.batch_tokens_eval,
+                                     args.batch_cost)
+        return evaluate(fullloader, model, args.precision)
+
+    sampleloader = get_sample_loader(dataset, n_sentences, args.batch_size_eval,
+                                     args.batch_tokens_eval, args.batch_cost, random_state)
+    results, intervals = evaluate_sample(sampleloader, model, len(dataset), args.precision)
+    print('Training sample of %d sentences: las +- %.4f uas +- %.4f' %
+          (len(sampleloader.dataset), intervals[0], intervals[1]))
+    return results
+
+
+def print_treebank_scores(dev_results, test_results):
+    if dev_results is None:
+        return
+    for name, (dev_las, dev_uas) in dev_results.items():
+        test_las, test_uas = test_results[name]
+        print('Final %s Dev las: %.4f Dev uas: %.4f Test las: %.4f Test uas: %.4f' %
+              (name, dev_las, dev_uas, test_las, test_uas))
+
+
 def main():
     # pylint: disable=too-many-locals
     args = get_args()
-    if args.model == "arc-standard":
-        transition_system = constants.arc_standard
-    elif args.model == "arc-eager":
-        transition_system = constants.arc_eager
-    elif args.model == "hybrid":
-        transition_system = constants.hybrid
+    # Transition-based parsers read the oracle actions of their own system
+    transitions = args.model if args.model in ["arc-standard", "arc-eager", "hybrid"] else None
 
     trainloader, devloader, testloader, vocabs, embeddings = \
-        get_data_loaders(args.data_path, args.language, args.batch_size, args.batch_size_eval, args.model,
-                         transition_system)
+        get_data_loaders(args.data_path, args.language, args.batch_size, args.batch_size_eval,
+                         transitions, batch_tokens=args.batch_tokens_train,
+                         batch_tokens_eval=args.batch_tokens_eval, batch_cost=args.batch_cost,
+                         num_workers=args.num_workers, pin_memory=args.pin_memory,
+                         stream=args.stream, shuffle_buffer=args.shuffle_buffer,
+                         temperature=args.temperature)
     print('Train size: %d Dev size: %d Test size: %d' %
-          (len(trainloader.dataset), len(devloader.dataset), len(testloader.dataset)))
+          (len(get_indexed_dataset(trainloader, args.stream)), len(devloader.dataset),
+           len(testloader.dataset)))
+
+    random_state = np.random.RandomState(args.seed)  # pylint: disable=no-member
+    devsample = None
+    if args.eval_sample is not None and args.eval_sample < len(devloader.dataset):
+        devsample = PrecollatedLoader(get_sample_loader(
+            devloader.dataset, args.eval_sample, args.batch_size_eval, args.batch_tokens_eval,
+            args.batch_cost, random_state))
 
     model = get_model(vocabs, embeddings, args)
     train(trainloader, devloader, model, args.eval_batches, args.wait_iterations,
-          args.optim, args.lr_decay, args.save_path, args.save_periodically)
+          args.optim, args.lr_decay, args.save_path, args.save_periodically, args.accumulate,
+          args.max_steps, devsample, args.precision)
 
     model.save(args.save_path)
 
-    train_loss, train_las, train_uas = evaluate(trainloader, model)
-    dev_loss, dev_las, dev_uas = evaluate(devloader, model)
-    test_loss, test_las, test_uas = evaluate(testloader, model)
+    train_loss, train_las, train_uas = evaluate_train(
+        trainloader, len(devloader.dataset), model, args, random_state)
+    (dev_loss, dev_las, dev_uas), dev_scores = evaluate_with_scores(
+        devloader, model, args.precision)
+    (test_loss, test_las, test_uas), test_scores = evaluate_with_scores(
+        testloader, model, args.precision)
 
     print('Final Training loss: %.4f Dev loss: %.4f Test loss: %.4f' %
           (train_loss, dev_loss, test_loss))
@@ -235,6 +475,10 @@ def main():
           (train_las, dev_las, test_las))
     print('Final Training uas: %.4f Dev uas: %.4f Test uas: %.4f' %
           (train_uas, dev_uas, test_uas))
+    print_treebank_scores(get_treebank_scores(devloader, dev_scores),
+                          get_treebank_scores(testloader, test_scores))
+    if args.precision != 'fp32':
+        compare_precision(devloader, model, args.precision)
 
 
 if __name__ == '__main__':
@@ -7,12 +7,14 @@ class TrainInfo:
     best_las = 0
     best_uas = 0
     best_batch = 0
+    best_treebanks = None
     lr_reductions = 0
     MAX_REDUCTIONS = 10
 
-    def __init__(self, wait_iterations, eval_batches):
+    def __init__(self, wait_iterations, eval_batches, max_steps=None):
         self.wait_iterations = wait_iterations
         self.eval_batches = eval_batches
+        self.max_steps = max_steps
 
     @property
     def stuck(self):
@@ -27,10 +29,14 @@ class TrainInfo:
 
         return False
 
+    @property
+    def out_of_steps(self):
+        return self.max_steps is not None and self.batch_id >= self.max_steps
+
     @property
     def finish(self):
         #print("is stuck {}".format(self.stuck))
-        return self.stuck and (self.lr_reductions >= self.MAX_REDUCTIONS)
+        return (self.stuck and (self.lr_reductions >= self.MAX_REDUCTIONS)) or self.out_of_steps
 
     @property
     def eval(self):
@@ -48,23 +54,39 @@ class TrainInfo:
         self.batch_id += 1
         self.running_loss += [loss]
 
-    def is_best(self, dev_results):
+    def is_best(self, dev_results, treebank_results=None):
+        # Models are selected on the dev set as a whole, treebank_results maps
+        # each treebank to its (las, uas) when several are trained together
         dev_loss, dev_las, dev_uas = dev_results
         # if dev_loss < self.best_loss:
         if dev_las > self.best_las:
             self.best_loss = dev_loss
             self.best_las = dev_las
             self.best_uas = dev_uas
+            self.best_treebanks = treebank_results
             self.best_batch = self.batch_id
             return True
 
         return False
 
+    def might_be_best(self, dev_las, las_interval):
+        # A sampled evaluation can only be a new best if its interval reaches past it
+        return dev_las + las_interval > self.best_las
+
     def reset_loss(self):
         self.running_loss = []
 
-    def print_progress(self, dev_results):
+    def print_progress(self, dev_results, intervals=None, treebank_results=None):
         dev_loss, dev_las, dev_uas = dev_results
-        print('(%05d/%05d) Training loss: %.4f Dev loss: %.4f Dev las: %.4f Dev uas: %.4f' %
-              (self.batch_id, self.max_epochs, self.avg_loss, dev_loss, dev_las, dev_uas))
+        if intervals is None:
+            print('(%05d/%05d) Training loss: %.4f Dev loss: %.4f Dev las: %.4f Dev uas: %.4f' %
+                  (self.batch_id, self.max_epochs, self.avg_loss, dev_loss, dev_las, dev_uas))
+        else:
+            print('(%05d/%05d) Training loss: %.4f Dev loss: %.4f Dev las: %.4f +- %.4f '
+                  'Dev uas: %.4f +- %.4f (sampled)' %
+                  (self.batch_id, self.max_epochs, self.avg_loss, dev_loss,
+                   dev_las, intervals[0], dev_uas, intervals[1]))
+        if treebank_results is not None:
+            print('\t' + ' '.join('%s las: %.4f uas: %.4f' % (name, las, uas)
+                                  for name, (las, uas) in treebank_results.items()))
         self.reset_loss()
@@ -0,0 +1,94 @@
+import sys
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+sys.path.append('./src/')
+from h02_learn.model.modules import Biaffine
+from utils import constants
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[20, 50, 100])
+    parser.add_argument('--hidden-size', type=int, default=400)
+    parser.add_argument('--arc-size', type=int, default=500)
+    parser.add_argument('--label-size', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=7)
+
+    return parser.parse_args()
+
+
+def run_separate(h_t, sent_lens, weights, biases, biaffine):
+    # Projection path before fusing: four matmuls, and a loop masking each sentence
+    arc_dep, arc_head, label_dep, label_head = [
+        F.relu(F.linear(h_t, weight, bias)) for weight, bias in zip(weights, biases)]
+    h_logits = biaffine(arc_head, arc_dep)
+    for i, sent_len in enumerate(sent_lens):
+        h_logits[i, sent_len:, :] = 0
+        h_logits[i, :, sent_len:] = 0
+    return h_logits, label_dep, label_head
+
+
+def run_fused(h_t, sent_lens, weight, bias, biaffine, sizes):
+    projected = F.relu(F.linear(h_t, weight, bias))
+    arc_dep, arc_head, label_dep, label_head = projected.split(sizes, dim=-1)
+    h_logits = biaffine(arc_head, arc_dep, sent_lens)
+    return h_logits, label_dep, label_head
+
+
+def time_run(func, repeats):
+    func()
+    if constants.device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if constants.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(batch_size, length, args):
+    # pylint: disable=too-many-locals
+    sizes = [args.arc_size, args.arc_size, args.label_size, args.label_size]
+    biaffine = Biaffine(args.arc_size, args.arc_size).to(device=constants.device)
+    weight = torch.randn(sum(sizes), args.hidden_size * 2, device=constants.device) * .05
+    bias = torch.randn(sum(sizes), device=constants.device) * .05
+    weights, biases = weight.split(sizes), bias.split(sizes)
+
+    h_t = torch.randn(batch_size, length, args.hidden_size * 2, device=constants.device)
+    sent_lens = torch.randint(1, length + 1, (batch_size,), device=constants.device)
+    sent_lens[0] = length
+
+    with torch.no_grad():
+        separate = run_separate(h_t, sent_lens, weights, biases, biaffine)
+        fused = run_fused(h_t, sent_lens, weight, bias, biaffine, sizes)
+        max_diff = max((x - y).abs().max().item() for x, y in zip(separate, fused))
+
+        time_separate = time_run(
+            lambda: run_separate(h_t, sent_lens, weights, biases, biaffine), args.repeats)
+        time_fused = time_run(
+            lambda: run_fused(h_t, sent_lens, weight, bias, biaffine, sizes), args.repeats)
+
+    print('%10d %6d %12.3f %12.3f %8.2fx %10.2e' %
+          (batch_size, length, time_separate * 1000, time_fused * 1000,
+           time_separate / time_fused, max_diff))
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+
+    print('%10s %6s %12s %12s %9s %10s' %
+          ('batch size', 'length', 'separate ms', 'fused ms', 'speedup', 'max diff'))
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            benchmark(batch_size, length, args)
+
+
+if __name__ == '__main__':
+    main()
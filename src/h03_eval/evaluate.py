@@ -3,25 +3,29 @@ import argparse
 
 sys.path.append('./src/')
 from h02_learn.dataset import get_data_loaders
+from h02_learn.dataset.sampler import BATCH_COSTS
 from h02_learn.model import BiaffineParser
-from h02_learn.train import evaluate
+from h02_learn.train import PRECISIONS, evaluate, compare_precision
 from utils import constants
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     # Data
-    parser.add_argument('--language', type=str, required=True)
+    parser.add_argument('--language', type=str, nargs='+', required=True)
     parser.add_argument('--data-path', type=str, default='data/')
     parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--batch-tokens', type=int, default=None)
+    parser.add_argument('--batch-cost', choices=BATCH_COSTS, default='tokens')
     # Model
     parser.add_argument('--checkpoints-path', type=str, default='checkpoints/')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32')
 
     return parser.parse_args()
 
 
 def load_model(checkpoints_path, language):
-    load_path = '%s/%s/' % (checkpoints_path, language)
+    load_path = '%s/%s/' % (checkpoints_path, '+'.join(language))
     return BiaffineParser.load(load_path).to(device=constants.device)
 
 
@@ -30,15 +34,17 @@ def main():
     args = get_args()
 
     trainloader, devloader, testloader, _, _ = \
-        get_data_loaders(args.data_path, args.language, args.batch_size, args.batch_size)
+        get_data_loaders(args.data_path, args.language, args.batch_size, args.batch_size,
+                         batch_tokens=args.batch_tokens, batch_tokens_eval=args.batch_tokens,
+                         batch_cost=args.batch_cost)
     print('Train size: %d Dev size: %d Test size: %d' %
           (len(trainloader.dataset), len(devloader.dataset), len(testloader.dataset)))
 
     model = load_model(args.checkpoints_path, args.language)
 
-    train_loss, train_las, train_uas = evaluate(trainloader, model)
-    dev_loss, dev_las, dev_uas = evaluate(devloader, model)
-    test_loss, test_las, test_uas = evaluate(testloader, model)
+    train_loss, train_las, train_uas = evaluate(trainloader, model, args.precision)
+    dev_loss, dev_las, dev_uas = evaluate(devloader, model, args.precision)
+    test_loss, test_las, test_uas = evaluate(testloader, model, args.precision)
 
     print('Final Training loss: %.4f Dev loss: %.4f Test loss: %.4f' %
           (train_loss, dev_loss, test_loss))
@@ -46,6 +52,8 @@ def main():
           (train_las, dev_las, test_las))
     print('Final Training uas: %.4f Dev uas: %.4f Test uas: %.4f' %
           (train_uas, dev_uas, test_uas))
+    if args.precision != 'fp32':
+        compare_precision(devloader, model, args.precision)
 
 
 if __name__ == '__main__':
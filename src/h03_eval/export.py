@@ -0,0 +1,104 @@
+import os
+import sys
+import argparse
+import torch
+
+sys.path.append('./src/')
+from h02_learn.dataset import get_data_loaders
+from h02_learn.model import BiaffineParser, MSTParser, NeuralTransitionParser
+from h02_learn.train import run_model
+from utils import constants
+
+MODELS = {
+    'biaffine': BiaffineParser,
+    'mst': MSTParser,
+    'arc-standard': NeuralTransitionParser,
+    'arc-eager': NeuralTransitionParser,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    # Data, the exported model is checked to parse its dev set as the original one
+    parser.add_argument('--language', type=str, nargs='+', required=True)
+    parser.add_argument('--data-path', type=str, default='data/')
+    parser.add_argument('--batch-size', type=int, default=128)
+    # Model
+    parser.add_argument('--model', choices=MODELS.keys(), default='biaffine')
+    parser.add_argument('--model-path', type=str, required=True)
+    parser.add_argument('--output-path', type=str, required=True)
+    # Words kept in the embedding tables, the most frequent in training come first.
+    # Defaults to every word seen in training.
+    parser.add_argument('--max-words', type=int, default=None)
+
+    return parser.parse_args()
+
+
+def get_size(path):
+    return sum(os.path.getsize(os.path.join(path, fname)) for fname in os.listdir(path))
+
+
+def get_outputs(devloader, model):
+    # Word representations of each dev batch, and the heads and relations predicted by
+    # graph-based parsers. Transition parsers draw the initial states of their stacks
+    # at random when built, and carry them between sentences, so their parses are not
+    # compared.
+    outputs = []
+    model.eval()
+    with torch.no_grad():
+        for (text, pos), (heads, rels), (transitions, relations_in_order) in devloader:
+            batch = [model.get_embeddings((text, pos))]
+            if isinstance(model, BiaffineParser):
+                _, predicted_heads, predicted_rels = run_model(
+                    model, text, pos, heads, rels, transitions, relations_in_order, mode='eval')
+                batch += [predicted_heads, predicted_rels]
+            outputs += [[tensor.cpu() for tensor in batch]]
+    return outputs
+
+
+def count_changed(outputs, outputs_exported):
+    # Sentences with any output of the exported model differing from the original one
+    changed = 0
+    for batch, batch_exported in zip(outputs, outputs_exported):
+        diffs = [(tensor != tensor_exported).reshape(tensor.shape[0], -1).any(-1)
+                 for tensor, tensor_exported in zip(batch, batch_exported)]
+        changed += torch.stack(diffs).any(0).sum().item()
+    return changed
+
+
+def main():
+    args = get_args()
+    model_cls = MODELS[args.model]
+    transitions = args.model if args.model in ['arc-standard', 'arc-eager'] else None
+    _, devloader, _, _, _ = get_data_loaders(
+        args.data_path, args.language, args.batch_size, args.batch_size, transitions)
+
+    model = model_cls.load(args.model_path).to(device=constants.device)
+    if model.pruned_words is not None:
+        raise ValueError('Model in %s is already pruned' % args.model_path)
+    outputs = get_outputs(devloader, model)
+
+    words, _, _ = model.vocabs
+    n_rows = min(args.max_words or words.train_size, words.size)
+    side_rows = model.prune_words(n_rows)
+    model.save(args.output_path)
+    model.save_side_tables(args.output_path, side_rows)
+
+    exported = model_cls.load(args.output_path).to(device=constants.device)
+    changed = count_changed(outputs, get_outputs(devloader, exported))
+    if changed:
+        raise ValueError('Exported model changes the outputs of %d of %d dev sentences' %
+                         (changed, len(devloader.dataset)))
+
+    size = os.path.getsize(model_cls.get_name(args.model_path))
+    size_exported = os.path.getsize(model_cls.get_name(args.output_path))
+    print('Kept %d of %d words, dev %s unchanged' %
+          (n_rows, words.size, 'parses are' if isinstance(model, BiaffineParser)
+           else 'word representations are'))
+    print('Checkpoint size: %.1f MB -> %.1f MB, with %.1f MB of side tables' %
+          (size / 2 ** 20, size_exported / 2 ** 20,
+           (get_size(args.output_path) - size_exported) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
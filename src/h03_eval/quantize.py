@@ -0,0 +1,75 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+
+sys.path.append('./src/')
+from h02_learn.dataset import get_data_loaders
+from h02_learn.train import evaluate
+from h03_eval.export import MODELS
+from utils import constants
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    # Data
+    parser.add_argument('--language', type=str, nargs='+', required=True)
+    parser.add_argument('--data-path', type=str, default='data/')
+    parser.add_argument('--batch-size', type=int, default=128)
+    # Model
+    parser.add_argument('--model', choices=MODELS.keys(), default='biaffine')
+    parser.add_argument('--model-path', type=str, required=True)
+    parser.add_argument('--output-path', type=str, required=True)
+    # Largest drop in dev LAS or UAS, in absolute points, before the quantized model is rejected
+    parser.add_argument('--max-drop', type=float, default=0.01)
+
+    return parser.parse_args()
+
+
+def time_evaluate(devloader, model):
+    # Dev batches are collated on the first pass, which is kept out of the timings
+    for _ in devloader:
+        pass
+    start = time.time()
+    results = evaluate(devloader, model)
+    return results, len(devloader.dataset) / (time.time() - start)
+
+
+def main():
+    args = get_args()
+    # Quantized kernels only run on the CPU, where both models are timed
+    if constants.device.type != 'cpu':
+        raise ValueError('Quantized models only run on the CPU, '
+                         'hide the GPUs with CUDA_VISIBLE_DEVICES=')
+    model_cls = MODELS[args.model]
+    transitions = args.model if args.model in ['arc-standard', 'arc-eager'] else None
+    _, devloader, _, _, _ = get_data_loaders(
+        args.data_path, args.language, args.batch_size, args.batch_size, transitions)
+
+    model = model_cls.load(args.model_path)
+    if model.quantized:
+        raise ValueError('Model in %s is already quantized' % args.model_path)
+    (_, las, uas), speed = time_evaluate(devloader, model)
+    model.quantize()
+    (_, las_quantized, uas_quantized), speed_quantized = time_evaluate(devloader, model)
+
+    print('fp32: %.1f sentences/s dev las: %.4f uas: %.4f' % (speed, las, uas))
+    print('int8: %.1f sentences/s dev las: %.4f uas: %.4f' %
+          (speed_quantized, las_quantized, uas_quantized))
+    print('Speedup: %.2fx' % (speed_quantized / speed))
+    if las - las_quantized > args.max_drop or uas - uas_quantized > args.max_drop:
+        raise ValueError('Quantized dev scores dropped by more than %.4f' % args.max_drop)
+
+    model.save(args.output_path)
+    # Exported models read pruned word embeddings from side tables, which are kept as they are
+    for fname in glob.glob('%s/*.side.npy' % args.model_path):
+        shutil.copy(fname, args.output_path)
+    print('Checkpoint size: %.1f MB -> %.1f MB' %
+          (os.path.getsize(model_cls.get_name(args.model_path)) / 2 ** 20,
+           os.path.getsize(model_cls.get_name(args.output_path)) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
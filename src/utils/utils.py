@@ -1,6 +1,8 @@
 import os
 import pathlib
 import json
+import itertools
+from collections import deque
 import pickle
 import numpy as np
 import torch
@@ -19,6 +21,25 @@ def append_json(fname, data):
         f.write("%s\n" % line)
 
 
+def get_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def ordered_imap(pool, func, iterable, max_pending):
+    # Like pool.imap, but only reads max_pending items ahead of the consumer
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def write_data(filename, embeddings):
     with open(filename, "wb") as f:
         pickle.dump(embeddings, f)